@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""ID remapping micro-benchmark.
+
+Compares the json.dumps / regex / json.loads remapping previously used by
+the import functions with the single walk of id_translator, on a synthetic
+tree of policy definitions holding 50k list references.
+
+Example: python benchmarks/bench_id_remap.py
+
+"""
+
+from collections import OrderedDict
+
+import copy
+import importlib.util
+import json
+import os
+import re
+import time
+import timeit
+import uuid
+
+SCRIPT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "sd-wan-exim.py")
+DEFINITIONS = 5000
+REFERENCES = 10
+LISTS = 500
+ROUNDS = 3
+
+
+def load_exim():
+    spec = importlib.util.spec_from_file_location("sd_wan_exim", SCRIPT_PATH)
+    exim = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(exim)
+    return exim
+
+
+def update_ids(item, list_id_old, list_id_new):
+    """Previous remapping, kept for comparison"""
+    def replace_id(match):
+        matched_id = match.group(0)
+        if matched_id in list_id_old:
+            old_id = list_id_old[matched_id]
+            new_id = list_id_new[old_id]
+            return new_id
+        else:
+            return matched_id
+
+    dict_json = re.sub(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}',
+                       replace_id, json.dumps(item))
+
+    return json.loads(dict_json, object_pairs_hook=OrderedDict)
+
+
+def build_ids():
+    list_id_old = OrderedDict()
+    list_id_new = OrderedDict()
+    for i in range(LISTS):
+        name = "site/list-{}".format(i)
+        list_id_old[str(uuid.uuid4())] = name
+        list_id_new[name] = str(uuid.uuid4())
+    return (list_id_old, list_id_new)
+
+
+def build_definitions(list_ids):
+    old_ids = list(list_ids)
+    definitions = []
+    for i in range(DEFINITIONS):
+        sequences = []
+        for j in range(REFERENCES):
+            sequences.append(OrderedDict([
+                ("sequenceId", j + 1),
+                ("sequenceName", "Sequence {}".format(j)),
+                ("baseAction", "accept"),
+                ("match", OrderedDict([("entries", [OrderedDict([
+                    ("field", "siteList"),
+                    ("ref", old_ids[(i * REFERENCES + j) % len(old_ids)])])])])),
+            ]))
+        definitions.append(OrderedDict([
+            ("definitionId", str(uuid.uuid4())),
+            ("name", "definition-{}".format(i)),
+            ("type", "control"),
+            ("description", "Synthetic definition"),
+            ("sequences", sequences),
+        ]))
+    return definitions
+
+
+def main():
+    exim = load_exim()
+    all_list_ids = build_ids()
+    definitions = build_definitions(all_list_ids[0])
+    print("{} definitions, {} references".format(DEFINITIONS, DEFINITIONS * REFERENCES))
+
+    expected = [update_ids(item, *all_list_ids) for item in definitions]
+    list_ids = exim.id_translator(all_list_ids)
+    translated = [list_ids.translate(json.loads(json.dumps(item), object_pairs_hook=OrderedDict)) for item in definitions]
+    assert translated == expected
+
+    def old():
+        for item in definitions:
+            update_ids(item, *all_list_ids)
+
+    def new(copies):
+        list_ids = exim.id_translator(all_list_ids)
+        for item in copies:
+            list_ids.translate(item)
+
+    old_time = min(timeit.repeat(old, number=1, repeat=ROUNDS))
+    new_time = None
+    for _ in range(ROUNDS):
+        # translate works in place, every round gets its own copy
+        copies = copy.deepcopy(definitions)
+        start = time.perf_counter()
+        new(copies)
+        elapsed = time.perf_counter() - start
+        new_time = elapsed if new_time is None else min(new_time, elapsed)
+    print("update_ids:    {:.3f}s".format(old_time))
+    print("id_translator: {:.3f}s".format(new_time))
+    print("speedup:       {:.1f}x".format(old_time / new_time))
+
+
+if __name__ == "__main__":
+    main()
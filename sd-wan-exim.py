@@ -20,6 +20,7 @@ or implied.
 Command line tool for Cisco SD-WAN vManage configuration management.
 
 Example: python sd-wan-exim.py <vManage> <username> <password> <action>
+         python sd-wan-exim.py -inventory <inventory> <action>
 
 Actions:
   export                      Export entire configuration.
@@ -47,20 +48,36 @@ Actions:
 
 from __future__ import print_function
 from pprint import pprint
-from collections import OrderedDict
+from collections import OrderedDict, deque
+from contextlib import contextmanager, redirect_stdout
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
 
 import requests
+import concurrent.futures
+import asyncio
+import threading
+import functools
 import sys
 import json
 import argparse
+import csv
+import traceback
 import tarfile
-import glob
+import tempfile
+import codecs
+import io
 import os
-import shutil
 import time
+import math
 import re
 import urllib.parse
+import email.utils
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None
+    import msvcrt
 
 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 
@@ -75,6 +92,18 @@ __status__ = "Development"
 """ GLOBAL VARIABLES """
 DIR_PATH = os.path.dirname(os.path.abspath(__file__))
 CONFIG_ARCH = "config_archive.tar.gz"
+VERSION_FILE = "export_version.json"
+SPOOL_SIZE = 8 * 1024 * 1024
+TASK_POLL_MIN = 1
+TASK_POLL_MAX = 30
+TASK_TIMEOUT = 15 * 60
+THROTTLE_STATUS = (429, 503)
+TRANSIENT_STATUS = (500, 502, 504)
+RETRIES = 5
+RETRY_BACKOFF_MAX = 60
+SESSION_TTL = 30 * 60
+UUID_RE = re.compile(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}')
+VERSION_KEYS = ("lastUpdatedOn", "lastUpdated", "version")
 ITEM_DIC =  {
                 "device_template" : ("template/device", "templateId"),
                 "feature_template" : ("template/feature", "templateId"),
@@ -85,17 +114,316 @@ ITEM_DIC =  {
                 "policy_list" : ("template/policy/list", "listId"),
                 "system_device" : ("system/device/vedges", "uuid")
             }
+BULK_KEYS = {
+                "template/feature" : ("templateDefinition",),
+                "template/policy/definition" : ("definition", "sequences"),
+                "template/policy/list" : ("entries",)
+            }
+DEFINITION_MOUNT_POINTS =  [
+                "/cflowd",
+                "/dnssecurity",
+                "/advancedMalwareProtection",
+                "/control",
+                "/intrusionprevention",
+                "/vedgeroute",
+                "/hubandspoke",
+                "/acl",
+                "/vpnmembershipgroup",
+                "/approute",
+                "/zonebasedfw",
+                "/urlfiltering",
+                "/qosmap",
+                "/aclv6",
+                "/mesh",
+                "/data",
+                "/rewriterule"
+            ]
+LIST_MOUNT_POINTS =  [
+                "/community",
+                "/localdomain",
+                "/dataipv6prefix",
+                "/ipv6prefix",
+                "/tloc",
+                "/umbrellasecret",
+                "/aspath",
+                "/zone",
+                "/color",
+                "/sla",
+                "/localapp",
+                "/app",
+                "/mirror",
+                "/dataprefix",
+                "/extcommunity",
+                "/site",
+#               "/ipprefixall"
+                "/prefix",
+                "/umbrelladata",
+                "/class",
+                "/ipssignature",
+#               "/dataprefixall",
+                "/urlblacklist",
+                "/policer",
+                "/urlwhitelist",
+                "/vpn",
+                "/tgapikey"
+            ]
 
 
 class CiscoException(Exception):
     pass
 
+class token_bucket:
+    """Rate limiter, rate requests per second on average and bursts of burst"""
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a request is allowed"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+class aimd_limiter:
+    """Concurrency limit adapting to the vManage throttling
+
+        The limit grows by one request once a full window of requests went
+        through (additive increase) and is halved when a request is throttled
+        (multiplicative decrease), between 1 and limit. Requests that were
+        already in flight when the limit was halved do not halve it again.
+
+    """
+    def __init__(self, limit):
+        self.max_limit = limit
+        self.limit = float(limit)
+        self.in_flight = 0
+        self.decreases = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """Block until a request may be sent, returns the ticket to release"""
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+            return self.decreases
+
+    def release(self, ticket, throttled):
+        with self.condition:
+            self.in_flight -= 1
+            if throttled:
+                if ticket == self.decreases:
+                    self.limit = max(1.0, self.limit / 2)
+                    self.decreases += 1
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+class session_cache:
+    """On-disk cache of vManage sessions
+
+        Sessions are stored by vManage, username and tenant with their
+        cookies, XSRF token and VSessionId. They expire SESSION_TTL seconds
+        after their last use, the vManage idle timeout. The file is only
+        readable by its owner. Updates hold a lock on <path>.lock, so the
+        processes of -inventory sharing the file keep each other's sessions.
+
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def read(self):
+        try:
+            with open(self.path) as f:
+                sessions = json.load(f)
+        except (EnvironmentError, ValueError):
+            return {}
+        now = time.time()
+        return {key: entry for key, entry in sessions.items() if entry["expires"] > now}
+
+    def load(self, key):
+        return self.read().get(key)
+
+    @contextmanager
+    def locked(self):
+        """Hold the lock of the cache file"""
+        with os.fdopen(os.open(self.path + ".lock", os.O_RDWR | os.O_CREAT, 0o600), "r+") as f:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            else:
+                msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+                else:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+    def save(self, key, entry):
+        with self.locked():
+            sessions = self.read()
+            sessions[key] = dict(entry, expires=time.time() + SESSION_TTL)
+            part_path = "{}.{}.part".format(self.path, os.getpid())
+            with os.fdopen(os.open(part_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as f:
+                json.dump(sessions, f)
+            os.replace(part_path, self.path)
+
+class request_profile:
+    """Requests of each endpoint family and wall time of each stage
+
+        Endpoint families are the mount points without their object IDs,
+        e.g. template/feature/object, the families of grouped_families also
+        without the segment following them, e.g. template/policy/list/*.
+        Latencies are the round trips of each attempt, retries included.
+
+    """
+    grouped_families = ("template/policy/list/", "template/policy/definition/", "system/device/", "device/action/status/")
+
+    def __init__(self):
+        self.endpoints = OrderedDict()
+        self.stages = OrderedDict()
+        self.lock = threading.Lock()
+
+    def family(self, method, mount_point):
+        segments = [segment for segment in mount_point.split("?")[0].strip("/").split("/")
+                    if not UUID_RE.fullmatch(segment) and not segment.isdigit()]
+        family = "/".join(segments)
+        for prefix in self.grouped_families:
+            if family.startswith(prefix):
+                family = prefix + "*"
+        return method + " " + family
+
+    def record(self, method, mount_point, seconds, sent, received):
+        """Record a request and its response"""
+        family = self.family(method, mount_point)
+        with self.lock:
+            endpoint = self.endpoints.setdefault(family, {"sent": 0, "received": 0, "latencies": []})
+            endpoint["sent"] += sent
+            endpoint["received"] += received
+            endpoint["latencies"].append(seconds)
+
+    @contextmanager
+    def stage(self, name):
+        """Record the wall time of the block as stage name"""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            seconds = time.monotonic() - start
+            with self.lock:
+                stage = self.stages.setdefault(name, {"count": 0, "seconds": 0.0})
+                stage["count"] += 1
+                stage["seconds"] += seconds
+
+    def percentile(self, latencies, percent):
+        """Nearest rank percentile of sorted latencies, in milliseconds"""
+        return latencies[max(0, int(math.ceil(len(latencies) * percent / 100.0)) - 1)] * 1000
+
+    def summary(self):
+        """Endpoints, busiest first, and stages as lists of dicts"""
+        with self.lock:
+            endpoints = []
+            for family, endpoint in self.endpoints.items():
+                latencies = sorted(endpoint["latencies"])
+                endpoints.append(OrderedDict([("endpoint", family), ("count", len(latencies)),
+                                              ("sent", endpoint["sent"]), ("received", endpoint["received"]),
+                                              ("total_ms", sum(latencies) * 1000),
+                                              ("p50_ms", self.percentile(latencies, 50)),
+                                              ("p95_ms", self.percentile(latencies, 95)),
+                                              ("p99_ms", self.percentile(latencies, 99))]))
+            stages = [OrderedDict([("stage", name), ("count", stage["count"]), ("seconds", stage["seconds"])])
+                      for name, stage in self.stages.items()]
+        endpoints.sort(key=lambda endpoint: endpoint["total_ms"], reverse=True)
+        return OrderedDict([("endpoints", endpoints), ("stages", stages)])
+
+    def report(self):
+        """Endpoint and stage tables"""
+        summary = self.summary()
+        lines = ["{:<46} {:>7} {:>11} {:>11} {:>9} {:>9} {:>9}".format("endpoint", "count", "sent", "received", "p50 ms", "p95 ms", "p99 ms")]
+        for endpoint in summary["endpoints"]:
+            lines.append("{endpoint:<46} {count:>7} {sent:>11} {received:>11} {p50_ms:>9.1f} {p95_ms:>9.1f} {p99_ms:>9.1f}".format(**endpoint))
+        lines.append("")
+        lines.append("{:<46} {:>7} {:>11}".format("stage", "count", "seconds"))
+        for stage in summary["stages"]:
+            lines.append("{stage:<46} {count:>7} {seconds:>11.2f}".format(**stage))
+        return "\n".join(lines)
+
 class rest_api_lib:
-    def __init__(self, vmanage_ip, username, password):
+    factory_template_msg = "Template is a factory default"
+    policy_list_ro_msg = "This policy list is a read only list and it cannot be deleted"
+    policy_list_partner = "This policy list is created by a partner and can only be removed when the partner is deleted."
+    delete_skip_msgs = (factory_template_msg, policy_list_ro_msg, policy_list_partner)
+    # polled until they change, never cached
+    uncached_mount_points = ("device/action/status",)
+    # writes to these action endpoints also change other collections
+    write_scopes = {"template/config": ("template/device",), "certificate/save": ("certificate",)}
+
+    def __init__(self, vmanage_ip, username, password, pool_size=1, ca_bundle=None, limit=1, rate=None, tenant=None, cache=None,
+                 cache_gets=False):
         self.vmanage_ip = vmanage_ip
         self.headers = {}
+        # GET responses of the collections, by tenant and mount point
+        self.responses = {} if cache_gets else None
+        self.responses_lock = threading.Lock()
+        self.responses_generation = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # VSessionId of the tenant each thread acts as, see as_tenant
+        self.tenant_session = threading.local()
+        self.limiter = aimd_limiter(limit)
+        self.bucket = token_bucket(rate, max(1.0, rate)) if rate else None
+        # updated by the worker threads, under counters_lock
+        self.throttled = 0
+        self.retried = 0
+        self.counters_lock = threading.Lock()
+        self.profile = request_profile()
         self.session = requests.session()
-        self.login(self.vmanage_ip, username, password)
+        self.session.headers['Connection'] = 'keep-alive'
+        # one pool of at most pool_size kept-alive connections to the vManage
+        self.adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount('https://', self.adapter)
+        # without a CA bundle the vManage certificate is not verified
+        self.verify = ca_bundle if ca_bundle else False
+        self.cache = cache
+        self.cache_key = "{}/{}/{}".format(vmanage_ip, username, tenant or "")
+        if not self.resume_session():
+            self.login(self.vmanage_ip, username, password)
+            if tenant:
+                self.use_tenant(tenant)
+            self.save_session()
+
+    def resume_session(self):
+        """Reuse the cached session if the vManage still accepts it"""
+        entry = self.cache.load(self.cache_key) if self.cache else None
+        if not entry:
+            return False
+        self.session.cookies.update(entry["cookies"])
+        self.headers.update(entry["headers"])
+        url = "https://%s/dataservice/client/server"%(self.vmanage_ip)
+        response = self.session.get(url, headers=self.headers, verify=self.verify)
+        if response.status_code == 200 and b'<html>' not in response.content:
+            print("Reusing cached session")
+            self.save_session()
+            return True
+        self.session.cookies.clear()
+        self.headers = {}
+        return False
+
+    def save_session(self):
+        if self.cache:
+            headers = {key: value.decode() if isinstance(value, bytes) else value for key, value in self.headers.items()}
+            self.cache.save(self.cache_key, {"cookies": requests.utils.dict_from_cookiejar(self.session.cookies), "headers": headers})
 
     def login(self, vmanage_ip, username, password):
         """Login to vmanage"""
@@ -110,13 +438,11 @@ class rest_api_lib:
         #Format data for loginForm
         login_data = {'j_username' : username, 'j_password' : password}
 
-        #If the vmanage has a certificate signed by a trusted authority change verify to True
-        login_response = self.session.post(url=login_url, data=login_data, verify=False)
+        login_response = self.session.post(url=login_url, data=login_data, verify=self.verify)
         if b'<html>' in login_response.content or login_response.status_code != 200:
             raise CiscoException('Login Failed: {0}'.format(login_response.status_code))
 
-        #If the vmanage has a certificate signed by a trusted authority change verify to True
-        token_response = self.session.get(url=token_url, verify=False)
+        token_response = self.session.get(url=token_url, verify=self.verify)
         if token_response.status_code == 200:
             self.headers['X-XSRF-TOKEN'] = token_response.content
         elif token_response.status_code == 404:
@@ -124,20 +450,154 @@ class rest_api_lib:
         else:
             raise CiscoException('Failed getting X-XSRF-TOKEN: {0}'.format(token_response.status_code))
 
-    def get_request(self, mount_point):
-        """GET request"""
+    def send(self, method, mount_point, payload=None):
+        """Send a request to the dataservice API, JSON payload if any
+
+            Writes drop the cached responses they change before being sent,
+            and again once answered, so a GET answered while the write was
+            in flight does not stay cached.
+
+        """
+        if method == 'GET':
+            return self.send_attempts(method, mount_point, payload)
+        self.invalidate(mount_point)
+        try:
+            return self.send_attempts(method, mount_point, payload)
+        finally:
+            self.invalidate(mount_point)
+
+    def send_attempts(self, method, mount_point, payload=None):
+        """Send a request, retried while throttled or failing transiently
+
+            Requests go through the rate limiter and the adaptive concurrency
+            limit. Throttled requests (429/503) are retried after their
+            Retry-After, transient failures (connection errors, 502/504 and
+            500 for GETs only, as the vManage also answers 500 to writes
+            that cannot succeed) after an exponential backoff, up to RETRIES
+            times. Retried POSTs that did go through end as duplicates, which
+            post_request accepts.
+
+        """
         url = "https://%s/dataservice/%s"%(self.vmanage_ip, mount_point)
 
-        response = self.session.get(url, headers=self.headers, verify=False)
+        headers = dict(self.headers)
+        vsessionid = self.tenant_session_id()
+        if vsessionid:
+            headers['VSessionId'] = vsessionid
+        if payload is not None:
+            payload = json.dumps(payload)
+            headers['Content-Type'] = 'application/json'
+
+        for attempt in range(RETRIES + 1):
+            ticket = self.limiter.acquire()
+            throttled = False
+            try:
+                if self.bucket:
+                    self.bucket.acquire()
+                start = time.monotonic()
+                response = self.session.request(method, url, data=payload, headers=headers, verify=self.verify)
+                self.profile.record(method, mount_point, time.monotonic() - start, len(payload) if payload else 0, len(response.content))
+                throttled = response.status_code in THROTTLE_STATUS
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if attempt == RETRIES:
+                    raise
+                print("{} {} failed, retrying: {}".format(method, mount_point, e))
+                self.count_retry(throttled=False)
+                time.sleep(min(RETRY_BACKOFF_MAX, 2 ** attempt))
+                continue
+            finally:
+                self.limiter.release(ticket, throttled)
+            if throttled:
+                self.count_retry(throttled=True)
+                time.sleep(self.retry_after(response, attempt))
+            elif response.status_code in TRANSIENT_STATUS and attempt < RETRIES and (method == 'GET' or response.status_code != 500):
+                self.count_retry(throttled=False)
+                time.sleep(min(RETRY_BACKOFF_MAX, 2 ** attempt))
+            else:
+                return response
+
+        print(response)
+        raise CiscoException("Fail - Throttled")
+
+    def count_retry(self, throttled):
+        """Count a throttled or otherwise retried request"""
+        with self.counters_lock:
+            if throttled:
+                self.throttled += 1
+            else:
+                self.retried += 1
+
+    def retry_after(self, response, attempt):
+        """Seconds to wait before retrying a throttled response"""
+        value = response.headers.get('Retry-After')
+        if value:
+            try:
+                return max(0.0, float(value))
+            except ValueError:
+                date = email.utils.parsedate_tz(value)
+                if date:
+                    return max(0.0, email.utils.mktime_tz(date) - time.time())
+        return min(RETRY_BACKOFF_MAX, 2 ** attempt)
+
+    def pool_stats(self):
+        """Connections opened and requests sent through the pool"""
+        connections = requests_sent = 0
+        for key in self.adapter.poolmanager.pools.keys():
+            pool = self.adapter.poolmanager.pools[key]
+            connections += pool.num_connections
+            requests_sent += pool.num_requests
+        return "Connections: {} opened, {} reused, {} requests, {} throttled, {} retried".format(connections, requests_sent - connections, requests_sent, self.throttled, self.retried)
+
+    def cache_stats(self):
+        """Hits and misses of the GET response cache"""
+        return "Cache: {} hits, {} misses".format(self.cache_hits, self.cache_misses)
+
+    def cache_scope(self, mount_point):
+        """Path prefix of the collection of a mount point, e.g. template/policy"""
+        return "/".join(mount_point.split("?")[0].split("/")[:2])
+
+    def cacheable(self, mount_point):
+        """Only collections are cached, single objects are fetched once anyway"""
+        last = mount_point.split("?")[0].rstrip("/").split("/")[-1]
+        return self.responses is not None and not mount_point.startswith(self.uncached_mount_points) and not UUID_RE.fullmatch(last)
+
+    def invalidate(self, mount_point):
+        """Drop the cached responses under the path prefix a write changes"""
+        if self.responses is None:
+            return
+        scope = self.cache_scope(mount_point)
+        scopes = (scope,) + self.write_scopes.get(scope, ())
+        with self.responses_lock:
+            self.responses_generation += 1
+            for key in [key for key in self.responses if key[1].startswith(scopes)]:
+                del self.responses[key]
+
+    def get_request(self, mount_point):
+        """GET request, collections are answered from the cache when enabled"""
+        cacheable = self.cacheable(mount_point)
+        if cacheable:
+            key = (self.tenant_session_id(), mount_point)
+            with self.responses_lock:
+                if key in self.responses:
+                    self.cache_hits += 1
+                    return self.responses[key]
+                self.cache_misses += 1
+                generation = self.responses_generation
+
+        response = self.send('GET', mount_point)
         #response.raise_for_status()
         data = response.content
 
+        if cacheable and response.status_code == 200:
+            with self.responses_lock:
+                # a write since the request may have made the response stale
+                if generation == self.responses_generation:
+                    self.responses[key] = data
+
         return data
 
     def post_request(self, mount_point, payload):
         """POST request"""
-        url = "https://%s/dataservice/%s"%(self.vmanage_ip, mount_point)
-
         dup_template_msg = "Template with name"
         dup_list_msg = "Duplicate policy list entry"
         dup_policy_msg = "Duplicate policy detected with name"
@@ -148,10 +608,7 @@ class rest_api_lib:
         version_msg = "Failed to create definition"
         unknown_msg = "Unknown error"
 
-        payload = json.dumps(payload)
-        self.headers['Content-Type'] = 'application/json'
-
-        response = self.session.post(url=url, data=payload, headers=self.headers, verify=False)
+        response = self.send('POST', mount_point, payload)
         if response.status_code != 200:
             if (response.status_code == 400):
                 response_details = str(response.json()['error']['details'])
@@ -180,12 +637,7 @@ class rest_api_lib:
 
     def put_request(self, mount_point, payload):
         """PUT request"""
-        url = "https://%s/dataservice/%s"%(self.vmanage_ip, mount_point)
-
-        payload = json.dumps(payload)
-        self.headers['Content-Type'] = 'application/json'
-
-        response = self.session.put(url=url, data=payload, headers=self.headers, verify=False)
+        response = self.send('PUT', mount_point, payload)
         if response.status_code != 200:
                 print(response.json()['error']['details'])
                 raise CiscoException("Fail - Put")
@@ -198,23 +650,14 @@ class rest_api_lib:
 
     def delete_request(self, mount_point):
         """DELETE request"""
-        url = "https://%s/dataservice/%s"%(self.vmanage_ip, mount_point)
-        factory_template_msg = "Template is a factory default"
-        policy_list_ro_msg = "This policy list is a read only list and it cannot be deleted"
-        policy_list_partner = "This policy list is created by a partner and can only be removed when the partner is deleted."
-
-        response = self.session.delete(url=url, headers=self.headers, verify=False)
+        response = self.send('DELETE', mount_point)
 
         data = response.content
 
         #print(response.status_code)
         if response.status_code != 200:
             if (response.status_code == 400):
-                if (response.json()['error']['details'] == factory_template_msg):
-                    return(response.json()['error']['details'])
-                elif(response.json()['error']['details'] == policy_list_ro_msg):
-                    return(response.json()['error']['details'])
-                elif(response.json()['error']['details'] == policy_list_partner):
+                if (response.json()['error']['details'] in self.delete_skip_msgs):
                     return(response.json()['error']['details'])
                 else:
                     print(response.json()['error']['details'])
@@ -231,7 +674,7 @@ class rest_api_lib:
         print("tenant")
 
         mount_point = "tenant"
-        response = json.loads(sdwanp.get_request(mount_point))
+        response = json.loads(self.get_request(mount_point))
         device_data = response["data"]
         tenant_id = ""
         for device in device_data:
@@ -242,57 +685,565 @@ class rest_api_lib:
 
         item = {}
         mount_point = "tenant/" + str(tenant_id) + "/switch"
-        response = sdwanp.post_request(mount_point, item)
+        response = self.post_request(mount_point, item)
 
         self.headers["VSessionId"] = response["VSessionId"]
 
+    def tenant_session_ids(self):
+        """VSessionId of every tenant by name, for a provider login"""
+        response = json.loads(self.get_request("tenant"))
+        vsessionids = OrderedDict()
+        for tenant in response["data"]:
+            response = self.post_request("tenant/" + str(tenant["tenantId"]) + "/vsessionid", {})
+            vsessionids[tenant["name"]] = response["VSessionId"]
+        return vsessionids
 
-def get_ids(generic_item):
+    def tenant_session_id(self):
+        """VSessionId the calling thread sends its requests with, if any"""
+        return getattr(self.tenant_session, "vsessionid", None)
+
+    def as_tenant(self, vsessionid, request, *args):
+        """Run request in the calling thread as the tenant of vsessionid
+
+            Other threads keep their own tenant, so tenants can share the
+            provider session and its connection pool.
+
+        """
+        previous = self.tenant_session_id()
+        self.tenant_session.vsessionid = vsessionid
+        try:
+            return request(*args)
+        finally:
+            self.tenant_session.vsessionid = previous
+
+class async_rest_api_lib:
+    """asyncio client for the vManage
+
+        Requests are sent through the rest_api_lib session, so they keep the
+        same semantics as the synchronous client, including the duplicate name
+        tolerance of post_request and the factory/read-only tolerance of
+        delete_request. A single event loop runs in a background thread and
+        at most `limit` requests are in flight at once.
+
+    """
+    def __init__(self, rest_api, limit):
+        self.rest_api = rest_api
+        self.executor = ThreadPoolExecutor(max_workers=limit)
+        self.loop = asyncio.new_event_loop()
+        self.loop.set_default_executor(self.executor)
+        self.thread = threading.Thread(target=self.run_loop, daemon=True)
+        self.thread.start()
+
+    def run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def call(self, request, *args):
+        """Coroutine running a blocking request on the client executor
+
+            The request is sent as the tenant of the thread creating the
+            coroutine, not of the executor thread running it.
+
+        """
+        return self.run_in_executor(functools.partial(self.rest_api.as_tenant, self.rest_api.tenant_session_id(), request, *args))
+
+    async def run_in_executor(self, request):
+        return await self.loop.run_in_executor(self.executor, request)
+
+    def get_request(self, mount_point):
+        """GET request"""
+        return self.call(self.rest_api.get_request, mount_point)
+
+    def post_request(self, mount_point, payload):
+        """POST request"""
+        return self.call(self.rest_api.post_request, mount_point, payload)
+
+    def put_request(self, mount_point, payload):
+        """PUT request"""
+        return self.call(self.rest_api.put_request, mount_point, payload)
+
+    def delete_request(self, mount_point):
+        """DELETE request"""
+        return self.call(self.rest_api.delete_request, mount_point)
+
+    def submit(self, coroutine):
+        """Schedule a coroutine on the event loop from synchronous code
+
+            Returns a concurrent.futures.Future.
+
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+
+def get_items(generic_item):
     mount_point, key_id = ITEM_DIC[generic_item]
     response = json.loads(sdwanp.get_request(mount_point))
-    device_data = response['data']
-    return [device[key_id] for device in device_data]
+    return response['data']
 
-def get_policy_definition_ids(mount_point):
-    new_mount_point = "template/policy/definition" + str(mount_point)
+def get_ids(generic_item):
+    mount_point, key_id = ITEM_DIC[generic_item]
+    return [device[key_id] for device in get_items(generic_item)]
+
+def is_full_listing(mount_point, device_data):
+    """Check if a listing already carries the full objects
+
+        A listing is complete when every item has one of the BULK_KEYS of its
+        mount point, partial listings need a GET per ID.
+
+    """
+    if mount_point not in BULK_KEYS:
+        return False
+    return all(any(key in device for key in BULK_KEYS[mount_point]) for device in device_data)
+
+def iter_futures(futures_list):
+    """Yield (key, result) of (key, future) pairs in order
+
+        futures_list is consumed lazily, at most 2 * SDWAN_WORKERS futures
+        run ahead of the one being consumed, so only a window of results is
+        held in memory. Pairs without a future are yielded with a None result.
+
+    """
+    window = 2 * SDWAN_WORKERS
+    pending = deque()
+    for key, future in futures_list:
+        pending.append((key, future))
+        while len(pending) > window:
+            key, future = pending.popleft()
+            yield key, future.result() if future else None
+    while pending:
+        key, future = pending.popleft()
+        yield key, future.result() if future else None
+
+def iter_requests(requests_list):
+    """GET the mount points of (key, mount_point) pairs, yielding (key, response)
+
+        Requests are sent concurrently on the asyncio client and yielded in
+        the same order as requests_list. Pairs without a mount point are
+        yielded with a None response.
+
+    """
+    return iter_futures((key, sdwanp_async.submit(sdwanp_async.get_request(mount_point)) if mount_point else None)
+                        for key, mount_point in requests_list)
+
+def iter_posts(posts_list):
+    """POST the (key, mount_point, payload) triples, yielding (key, response)
+
+        Same as iter_requests: objects are posted concurrently and yielded in
+        the same order as posts_list.
+
+    """
+    return iter_futures((key, sdwanp_async.submit(sdwanp_async.post_request(mount_point, payload)) if mount_point else None)
+                        for key, mount_point, payload in posts_list)
+
+def get_policy_items(base_mount_point, mount_point):
+    new_mount_point = base_mount_point + str(mount_point)
     response = sdwanp.get_request(new_mount_point)
     if response:
         response = json.loads(response)
-        device_data = response['data']
-        return [device["definitionId"] for device in device_data]
+        return response['data']
     else:
         return []
 
+def get_policy_listing(base_mount_point, mount_point, key_id):
+    """Listing of a policy type, reduced to what the export keeps of it
+
+        Returns (True, items) for a complete listing in bulk mode, otherwise
+        (False, [(id, version)]) so the full listing is not held.
+
+    """
+    device_data_list = get_policy_items(base_mount_point, mount_point)
+    if SDWAN_BULK and is_full_listing(base_mount_point, device_data_list):
+        return True, device_data_list
+    return False, [(device[key_id], get_version(device)) for device in device_data_list]
+
+def get_policy_definition_ids(mount_point):
+    return [device["definitionId"] for device in get_policy_items("template/policy/definition", mount_point)]
+
 def get_policy_list_ids(mount_point):
-    new_mount_point = "template/policy/list" + str(mount_point)
-    response = sdwanp.get_request(new_mount_point)
-    if response:
-        response = json.loads(response)
-        device_data = response['data']
-        return [device["listId"] for device in device_data]
-    else:
-        return []
+    return [device["listId"] for device in get_policy_items("template/policy/list", mount_point)]
 
-def update_ids(item, list_id_old, list_id_new):
-    def replace_id(match):
-        matched_id = match.group(0)
-        if matched_id in list_id_old:
-            old_id = list_id_old[matched_id]
-            new_id = list_id_new[old_id]
-            return new_id
-        else:
-            return matched_id
+def get_version(device):
+    return [device.get(key) for key in VERSION_KEYS]
+
+class previous_export:
+    """Objects of a previous export archive
+
+        Only the version and the position in its file of every object are
+        held, {item: {id: (version, position)}}, built from the version file
+        of the archive. Archives without it are fully exported again.
+        Unchanged objects are read back from the archive one at a time by
+        read(), through a streaming reader per file that only moves forward
+        while the objects are read in the order they were written.
+
+    """
+    def __init__(self, archive_path):
+        self.archive_path = archive_path
+        try:
+            self.tar = tarfile.open(archive_path)
+        except EnvironmentError: # parent of IOError, OSError
+            raise CiscoException("File {} not found or with errors!".format(archive_path))
+
+        self.items = {}
+        self.readers = {}
+        version_file = open_archive_file(self.tar, VERSION_FILE)
+        if version_file is None:
+            print("No version information in {}, exporting everything".format(archive_path))
+            return
+        versions = load_json_from_file(version_file)["configuration"]
+
+        # position of the objects in their file, groups follow each other
+        offsets = {}
+        for item, versions_list in versions.items():
+            file_name = item.partition("/")[0]
+            offset = offsets.get(file_name, 0)
+            self.items[item] = {id : (version, offset + position) for position, (id, version) in enumerate(versions_list)}
+            offsets[file_name] = offset + len(versions_list)
+
+    def unchanged(self, item, id, version):
+        """Whether the object of id was exported with the same version"""
+        if id in self.items.get(item, {}) and any(value is not None for value in version):
+            return self.items[item][id][0] == version
+        return False
+
+    def read(self, item, id):
+        """Previously exported object of id"""
+        file_name = item.partition("/")[0]
+        position = self.items[item][id][1]
+        reader, next_position = self.readers.get(file_name, (None, 0))
+        if reader is None or position < next_position:
+            # read out of order, start the file over
+            reader, next_position = iter_json_from_file(open_archive_file(self.tar, file_name + ".json")), 0
+        for _ in range(position - next_position):
+            next(reader)
+        _, device_data = next(reader)
+        self.readers[file_name] = (reader, position + 1)
+        return device_data
+
+    def close(self):
+        for reader, _ in self.readers.values():
+            reader.close()
+        self.tar.close()
+
+class id_translator:
+    """Translate old IDs to new IDs
+
+        The (id_old, id_new) pairs returned by the import functions map old
+        IDs to names and names to new IDs, they are compiled once into a
+        single old -> new dictionary. Old IDs whose name has no new ID are
+        recorded in unresolved when they are met.
 
-    dict_json = re.sub(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}',
-                       replace_id, json.dumps(item))
+    """
+    def __init__(self, *all_ids):
+        self.ids = {}
+        self.names = {}
+        self.unresolved = []
+        for id_old, id_new in all_ids:
+            for old_id, name in id_old.items():
+                if name in id_new:
+                    self.ids[old_id] = id_new[name]
+                else:
+                    self.names[old_id] = name
+
+    def translate_id(self, id, default=None):
+        """Translate one ID, IDs that cannot be translated give default if set"""
+        if id in self.ids:
+            return self.ids[id]
+        if id in self.names:
+            self.unresolved.append(self.names[id])
+        return id if default is None else default
+
+    def resolve_id(self, id):
+        """Translate an ID that must be translated, unknown IDs are unresolved too"""
+        if id in self.ids:
+            return self.ids[id]
+        self.unresolved.append(self.names.get(id, id))
+        return id
+
+    def translate_match(self, match):
+        return self.translate_id(match.group(0))
+
+    def translate_string(self, value):
+        if len(value) < 36:
+            return value
+        if len(value) == 36:
+            return self.translate_id(value)
+        return UUID_RE.sub(self.translate_match, value)
+
+    def translate(self, item):
+        """Translate every ID found in the values of item, in one walk
+
+            Dictionaries and lists are updated in place, item is returned.
+
+        """
+        if isinstance(item, dict):
+            for key, value in item.items():
+                if isinstance(value, str):
+                    item[key] = self.translate_string(value)
+                elif isinstance(value, (dict, list)):
+                    self.translate(value)
+        elif isinstance(item, list):
+            for i, value in enumerate(item):
+                if isinstance(value, str):
+                    item[i] = self.translate_string(value)
+                elif isinstance(value, (dict, list)):
+                    self.translate(value)
+        elif isinstance(item, str):
+            return self.translate_string(item)
+        return item
+
+    def take_unresolved(self):
+        """Return and forget the references that could not be translated"""
+        unresolved = sorted(set(self.unresolved))
+        self.unresolved = []
+        return unresolved
+
+    def check(self, name):
+        """Raise for the references of name that could not be translated"""
+        unresolved = self.take_unresolved()
+        if unresolved:
+            raise CiscoException("Unresolved references in {}: {}".format(name, ", ".join(unresolved)))
+
+
+def resolve_template_ids(feature_ids, templates):
+    """Translate the templateId of templates and of their subTemplates, at any depth"""
+    for template in templates:
+        template["templateId"] = feature_ids.resolve_id(template["templateId"])
+        resolve_template_ids(feature_ids, template.get("subTemplates", []))
+
+def resolve_device_template(item, feature_ids, policy_ids):
+    """Translate the policy and feature template references of a device template
+
+        Returns the references that could not be translated.
 
-    return json.loads(dict_json, object_pairs_hook=OrderedDict)
+    """
+    item["policyId"] = policy_ids.translate_id(item.get("policyId"), "")
+    item["securityPolicyId"] = policy_ids.translate_id(item.get("securityPolicyId"), "")
+    resolve_template_ids(feature_ids, item.get("generalTemplates", []))
+    return policy_ids.take_unresolved() + feature_ids.take_unresolved()
 
 
-def load_json_from_file(fp):
-    with open(fp) as f:
+def load_json_from_file(f):
+    with f:
         return json.load(f, object_pairs_hook=OrderedDict)
 
+def open_archive_file(tar, file_name):
+    """Open a member of the archive as text, None when it is not present"""
+    try:
+        member = tar.getmember(file_name)
+    except KeyError:
+        return None
+    return io.TextIOWrapper(tar.extractfile(member), encoding="utf-8")
+
+@contextmanager
+def create_archive_file(tar, file_name):
+    """Write a member of the archive
+
+        The member is written as text to a spooled temporary file, kept in
+        memory up to SPOOL_SIZE, and added to the archive when the block
+        exits.
+
+    """
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE) as f:
+        yield codecs.getwriter("utf-8")(f)
+        member = tarfile.TarInfo(file_name)
+        member.size = f.tell()
+        member.mtime = time.time()
+        member.mode = 0o644
+        f.seek(0)
+        tar.addfile(member, f)
+
+class json_stream_reader:
+    """Read the values of a JSON file one at a time
+
+        The file is read in chunks and every value is decoded as soon as it
+        is complete, only the current value is held in memory.
+
+    """
+    def __init__(self, f, chunk_size=65536):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buffer = ""
+        self.pos = 0
+        self.decoder = json.JSONDecoder(object_pairs_hook=OrderedDict)
+
+    def fill(self):
+        """Read more of the file, dropping what was already decoded"""
+        chunk = self.f.read(max(self.chunk_size, len(self.buffer) - self.pos))
+        if not chunk:
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Return the next non whitespace character, empty at the end of the file"""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buffer) or not self.fill():
+                return self.buffer[self.pos:self.pos + 1]
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError("Expecting '{}' at '{}'".format(char, self.buffer[self.pos:self.pos + 20]))
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # a value not followed by a delimiter may continue in the file
+                if self.buffer[end:end + 1] in (",", "]", "}", ":") or self.buffer[end:end + 1].isspace() or not self.fill():
+                    self.pos = end
+                    return value
+            except ValueError:
+                if not self.fill():
+                    raise
+
+    def array(self):
+        """Iterate the values of an array"""
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.peek() != ",":
+                break
+            self.pos += 1
+        self.expect("]")
+
+def iter_json_from_file(f):
+    """Iterate the configuration of a file written by json_stream_writer
+
+        Yields (None, item) for every item of a {"configuration": [...]} file
+        and (group, item) for a grouped {"configuration": {group: [...]}} file.
+
+    """
+    with f:
+        reader = json_stream_reader(f)
+        reader.expect("{")
+        if reader.value() != "configuration":
+            raise ValueError("No configuration in {}".format(getattr(f, "name", "file")))
+        reader.expect(":")
+        if reader.peek() == "[":
+            for item in reader.array():
+                yield None, item
+        else:
+            reader.expect("{")
+            while reader.peek() == '"':
+                group = reader.value()
+                reader.expect(":")
+                for item in reader.array():
+                    yield group, item
+                if reader.peek() == ",":
+                    reader.pos += 1
+            reader.expect("}")
+
+class json_stream_writer:
+    """Write a {"configuration": ...} file one object at a time
+
+        Objects are written as they are appended, so only one of them has to
+        be held in memory. The output is the same as json.dump and is read
+        back by load_json_from_file. Grouped files hold a dictionary of lists,
+        a new list is started by group().
+
+    """
+    def __init__(self, f, grouped=False):
+        self.f = f
+        self.grouped = grouped
+        self.groups = 0
+        self.items = 0
+
+    def __enter__(self):
+        self.f.write('{"configuration": ' + ('{' if self.grouped else '['))
+        return self
+
+    def group(self, name):
+        if self.groups:
+            self.f.write('], ')
+        self.f.write(json.dumps(name) + ': [')
+        self.groups += 1
+        self.items = 0
+
+    def append(self, item):
+        if self.items:
+            self.f.write(', ')
+        self.f.write(json.dumps(item))
+        self.items += 1
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.grouped:
+            self.f.write(']}}' if self.groups else '}}')
+        else:
+            self.f.write(']}')
+
+class import_journal:
+    """Resume journal of the objects created by an import
+
+        Every object created on the vManage is appended to the journal file
+        as a JSON line with its stage, name and new ID, so an interrupted
+        import can be run again without posting them twice. Only the lines
+        of the same vManage and tenant are used. Once an import completes a
+        complete line is appended, the objects recorded before it are then
+        forgotten, so the journal can be reused for the next import. Without
+        a path nothing is recorded.
+
+    """
+    def __init__(self, path, target):
+        self.path = path
+        self.target = target
+        self.ids = {}
+        self.lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # last line of an interrupted run
+                        continue
+                    if entry["vmanage"] != target:
+                        continue
+                    if entry.get("complete"):
+                        self.ids = {}
+                    else:
+                        self.ids[(entry["item"], entry["name"])] = entry["id"]
+
+    def get(self, item, name):
+        """New ID of a journaled object, None if it was not created yet"""
+        return self.ids.get((item, name))
+
+    def record(self, item, name, new_id):
+        if not self.path or self.ids.get((item, name)) == new_id:
+            return
+        with self.lock:
+            self.ids[(item, name)] = new_id
+            with open(self.path, "a") as f:
+                f.write(json.dumps(OrderedDict([("vmanage", self.target), ("item", item), ("name", name), ("id", new_id)])) + "\n")
+
+    def record_response(self, item, name, response, id_key):
+        """Record the new ID of a POST response, if it carries one"""
+        if isinstance(response, dict) and id_key in response:
+            self.record(item, name, response[id_key])
+
+    def complete(self):
+        """Forget the recorded objects once the import completed"""
+        if not self.path:
+            return
+        with self.lock:
+            self.ids = {}
+            # appended like the records, other vManages may share the file
+            with open(self.path, "a") as f:
+                f.write(json.dumps(OrderedDict([("vmanage", self.target), ("complete", True)])) + "\n")
+
+    def record_ids(self, item, id_new, names):
+        """Record the new IDs of names found by collect_new_ids"""
+        for name in names:
+            if name in id_new:
+                self.record(item, name, id_new[name])
+
 def action_print(msg):
     print("Action:")
     print(msg)
@@ -306,275 +1257,330 @@ def wait(minutes):
             print("Remaining time {} minute/minutes".format(i-1))
     print("")
 
+def wait_for_tasks(responses, minutes):
+    """Wait for the vManage tasks started by the POST responses
+
+        The action status of the tasks is polled, backing off from
+        TASK_POLL_MIN to TASK_POLL_MAX seconds, until they are all done or
+        TASK_TIMEOUT seconds have passed. When a response carries no task ID
+        the fixed wait of minutes is kept, if any. Returns the per device
+        status entries of the tasks.
+
+    """
+    task_ids = [response.get("id") if isinstance(response, dict) else None for response in responses]
+    if not all(task_ids):
+        if minutes:
+            wait(minutes)
+        return []
+    if not task_ids:
+        return []
+
+    print("Waiting for {} task/tasks".format(len(task_ids)))
+    device_status = []
+    delay = TASK_POLL_MIN
+    deadline = time.monotonic() + TASK_TIMEOUT
+    while task_ids:
+        pending = []
+        for task_id, response in iter_requests((task_id, "device/action/status/" + str(task_id)) for task_id in task_ids):
+            status = json.loads(response)
+            summary = status.get("summary", {})
+            if summary.get("status") == "done":
+                device_status.extend(status.get("data", []))
+                if "count" in summary:
+                    print("Task {} done: {}".format(task_id, summary["count"]))
+                else:
+                    print("Task {} done".format(task_id))
+            else:
+                pending.append(task_id)
+        task_ids = pending
+        if task_ids:
+            if time.monotonic() + delay > deadline:
+                raise CiscoException("Tasks {} not done after {} seconds".format(", ".join(task_ids), TASK_TIMEOUT))
+            time.sleep(delay)
+            delay = min(delay * 2, TASK_POLL_MAX)
+    print("")
+    return device_status
+
 
-def export_generic_item(file_path, generic_item, mount_point):
+def export_generic_item(tar, generic_item, mount_point, previous=None):
     """Export generic_item
 
-        Data is exported as JSON in a separate folder called configuration.
+        Data is exported as JSON into the configuration archive.
+        Objects whose version did not change since the previous export are
+        reused instead of fetched again.
+
+        Returns the ID and version of every exported object.
 
     """
     print(generic_item)
 
-    json_file = os.path.join(file_path, str(generic_item) + ".json")
-
-    ids_list = get_ids(generic_item)
+    list_mount_point, key_id = ITEM_DIC[generic_item]
+    device_data_list = get_items(generic_item)
+    versions = []
 
-    export_data = OrderedDict({"configuration": []})
-
-    for id in ids_list:
-        print("Exporting ID: {}".format(id))
-        new_mount_point = str(mount_point) + "/" + str(id)
-        device_data = json.loads(sdwanp.get_request(new_mount_point))
-        if device_data:
-            export_data["configuration"].append(device_data)
+    with create_archive_file(tar, str(generic_item) + ".json") as f, json_stream_writer(f) as writer:
+        if SDWAN_BULK and is_full_listing(list_mount_point, device_data_list):
+            print("Exporting {} items from the {} listing".format(len(device_data_list), list_mount_point))
+            for device_data in device_data_list:
+                if device_data:
+                    writer.append(device_data)
+                    versions.append([device_data[key_id], get_version(device_data)])
+            return versions
+
+        # only the ID and version of the objects are kept while they are fetched
+        ids_list = [(device[key_id], get_version(device)) for device in device_data_list]
+        del device_data_list
+
+        requests_list = []
+        for id, version in ids_list:
+            reused = previous is not None and previous.unchanged(generic_item, id, version)
+            new_mount_point = str(mount_point) + "/" + str(id) if not reused else None
+            requests_list.append(((id, version), new_mount_point))
+
+        for (id, version), response in iter_requests(requests_list):
+            if response is not None:
+                print("Exporting ID: {}".format(id))
+                device_data = json.loads(response)
+            else:
+                print("Reusing ID: {}".format(id))
+                device_data = previous.read(generic_item, id)
+            if device_data:
+                writer.append(device_data)
+                versions.append([id, version])
 
-    with open(json_file, 'w') as f:
-        json.dump(export_data, f)
+    return versions
 
-def export_generic_policy_ids(file_path, generic_item, mount_point):
+def export_generic_policy_ids(tar, generic_item, mount_point):
     """Export generic_item IDs
 
-        Data is exported as JSON in a separate folder called configuration.
+        Data is exported as JSON into the configuration archive.
 
     """
     print(generic_item)
 
-    json_file = os.path.join(file_path, str(generic_item) + ".json")
-
     export_data = OrderedDict({"configuration": []})
 
     device_data = json.loads(sdwanp.get_request(mount_point))
     if device_data:
         export_data["configuration"] = device_data
 
-    with open(json_file, 'w') as f:
+    with create_archive_file(tar, str(generic_item) + ".json") as f:
         json.dump(export_data, f)
 
-def export_policy_definitions(file_path):
+def export_policy_items(writer, generic_item, base_mount_point, key_id, mount_points, previous):
+    """Export policy items of every type in mount_points
+
+        The listing of every type is requested up front and the items are
+        fetched in mount_points order through iter_requests, so the items of
+        a type are requested as soon as its listing returns and the window
+        allows. In bulk mode complete listings are exported as they are, and
+        items unchanged since the previous export are read back from it as
+        they are written. Every type is written as a group of writer.
+
+        Returns the ID and version of every exported item per type.
+
+    """
+    listings = OrderedDict((mount_point, sdwanp_async.submit(sdwanp_async.call(get_policy_listing, base_mount_point, mount_point, key_id)))
+                           for mount_point in mount_points)
+
+    def policy_requests():
+        while listings:
+            # a listing is dropped once its items are requested
+            mount_point, listing = listings.popitem(last=False)
+            try:
+                bulk, device_data_list = listing.result()
+                print("Exporting done for {0}".format(mount_point))
+            except (ValueError, KeyError):
+                # types the vManage does not have answer with an error page
+                # or without data, transport errors and retries running out
+                # are raised instead of leaving the type out of the archive
+                print("Exporting skipped for {0}, not present".format(mount_point))
+                continue
+            del listing
+            yield (mount_point, None, None, None, False), None
+            if bulk:
+                for device in device_data_list:
+                    yield (mount_point, device[key_id], get_version(device), device, False), None
+                continue
+            for id, version in device_data_list:
+                if previous is not None and previous.unchanged(generic_item + str(mount_point), id, version):
+                    yield (mount_point, id, version, None, True), None
+                else:
+                    yield (mount_point, id, version, None, False), base_mount_point + str(mount_point) + "/" + str(id)
+
+    versions = OrderedDict()
+
+    for (mount_point, id, version, device_data, reused), response in iter_requests(policy_requests()):
+        if id is None:
+            writer.group(mount_point)
+            versions[mount_point] = []
+            continue
+        if response is not None:
+            device_data = json.loads(response)
+        elif reused:
+            device_data = previous.read(generic_item + str(mount_point), id)
+        print("{} ID: {}".format("Reusing" if reused else "Exporting", id))
+        if device_data:
+            writer.append(device_data)
+            versions[mount_point].append([id, version])
+
+    return versions
+
+def export_policy_definitions(tar, previous=None):
     """Export policy definitions
 
-        Data is exported as JSON in a separate folder called configuration.
+        Data is exported as JSON into the configuration archive.
+
+        Returns the ID and version of every exported definition per type.
 
     """
     print("policy_definition")
 
-    policy_definition_json_file = os.path.join(file_path, "policy_definition.json")
-
-    policy_definition_ids_list = OrderedDict({})
-
-    definition_mount_points =    [
-        "/cflowd",
-        "/dnssecurity",
-        "/advancedMalwareProtection",
-        "/control",
-        "/intrusionprevention",
-        "/vedgeroute",
-        "/hubandspoke",
-        "/acl",
-        "/vpnmembershipgroup",
-        "/approute",
-        "/zonebasedfw",
-        "/urlfiltering",
-        "/qosmap",
-        "/aclv6",
-        "/mesh",
-        "/data",
-        "/rewriterule"
-                                ]
-    for mount_point in definition_mount_points:
-        try:
-            print("Exporting done for {0}".format(mount_point))
-            policy_definition_ids_list[mount_point] = get_policy_definition_ids(mount_point)
-        except:
-            print("Exporting skipped for {0}, not present".format(mount_point))
-    #pprint(policy_definition_ids_list)
-
-    policy_definitions = OrderedDict({"configuration": OrderedDict()})
-
-    for mount_point in definition_mount_points:
-        device_data_list = []
-        if mount_point in policy_definition_ids_list:
-            for id in policy_definition_ids_list[mount_point]:
-                print("Exporting ID: {}".format(id))
-                new_mount_point = "template/policy/definition" + str(mount_point) + "/" + str(id)
-                device_data = json.loads(sdwanp.get_request(new_mount_point))
-                if device_data:
-                    device_data_list.append(device_data)
-            policy_definitions["configuration"][mount_point] = device_data_list
-
-    with open(policy_definition_json_file, 'w') as f:
-        json.dump(policy_definitions, f)
+    with create_archive_file(tar, "policy_definition.json") as f, json_stream_writer(f, grouped=True) as writer:
+        return export_policy_items(writer,
+                                   "policy_definition",
+                                   "template/policy/definition",
+                                   "definitionId",
+                                   DEFINITION_MOUNT_POINTS,
+                                   previous)
 
-def export_policy_lists(file_path):
+def export_policy_lists(tar, previous=None):
     """Export policy lists
 
-        Data is exported as JSON in a separate folder called configuration.
+        Data is exported as JSON into the configuration archive.
+
+        Returns the ID and version of every exported list per type.
 
     """
     print("policy_list")
 
-    policy_list_json_file = os.path.join(file_path, "policy_list.json")
-
-    policy_list_ids_list = OrderedDict({})
-
-
-    list_mount_points =    [
-      "/community",
-      "/localdomain",
-      "/dataipv6prefix",
-      "/ipv6prefix",
-      "/tloc",
-      "/umbrellasecret",
-      "/aspath",
-      "/zone",
-      "/color",
-      "/sla",
-      "/localapp",
-      "/app",
-      "/mirror",
-      "/dataprefix",
-      "/extcommunity",
-      "/site",
-#      "/ipprefixall"
-      "/prefix",
-      "/umbrelladata",
-      "/class",
-      "/ipssignature",
-#      "/dataprefixall",
-      "/urlblacklist",
-      "/policer",
-      "/urlwhitelist",
-      "/vpn",
-      "/tgapikey"
-                            ]
-    for mount_point in list_mount_points:
-        try:
-            print("Exporting done for {0}".format(mount_point))
-            policy_list_ids_list[mount_point] = get_policy_list_ids(mount_point)
-        except:
-            print("Exporting skipped for {0}, not present".format(mount_point))
-    #pprint(policy_definition_ids_list)
-
-    policy_lists = OrderedDict({"configuration": OrderedDict()})
-
-    for mount_point in list_mount_points:
-        device_data_list = []
-        if mount_point in policy_list_ids_list:
-            for id in policy_list_ids_list[mount_point]:
-                print("Exporting ID: {}".format(id))
-                new_mount_point = "template/policy/list" + str(mount_point) + "/" + str(id)
-                device_data = json.loads(sdwanp.get_request(new_mount_point))
-                if device_data:
-                    device_data_list.append(device_data)
-            policy_lists["configuration"][mount_point] = device_data_list
+    with create_archive_file(tar, "policy_list.json") as f, json_stream_writer(f, grouped=True) as writer:
+        return export_policy_items(writer,
+                                   "policy_list",
+                                   "template/policy/list",
+                                   "listId",
+                                   LIST_MOUNT_POINTS,
+                                   previous)
 
-    with open(policy_list_json_file, 'w') as f:
-        json.dump(policy_lists, f)
-
-
-def delete_generic_item(generic_item):
-    print(generic_item)
 
-    ids_list = get_ids(generic_item)
+def generic_item_deletes(generic_item):
     mount_point, key_id = ITEM_DIC[generic_item]
     if (generic_item == "system_device"):
         mount_point = "system/device"
+        # only the devices of the SDWAN_DEVICES filter when set
+        ids_list = [device[key_id] for device in get_items(generic_item)
+                    if device_selected(device[key_id], device.get("chasisNumber"), device.get("serialNumber"))]
+    else:
+        ids_list = get_ids(generic_item)
     for id in ids_list:
-        print("Deleting ID: {} - ".format(id), end="")
-        id = urllib.parse.quote(id, safe='')
-        new_mount_point = str(mount_point) + "/" + str(id)
-
-        response = sdwanp.delete_request(new_mount_point)
-        print(response)
-    print("")
+        yield id, str(mount_point) + "/" + urllib.parse.quote(id, safe='')
+
+def policy_item_deletes(base_mount_point, mount_points, get_policy_ids):
+    listings = ((mount_point, sdwanp_async.submit(sdwanp_async.call(get_policy_ids, mount_point))) for mount_point in mount_points)
+    for mount_point, ids_list in iter_futures(listings):
+        for id in ids_list:
+            yield id, base_mount_point + str(mount_point) + "/" + str(id)
+
+def item_deletes(item):
+    """(id, mount point) of every object of item"""
+    if item == "policy_definition":
+        return policy_item_deletes("template/policy/definition", DEFINITION_MOUNT_POINTS, get_policy_definition_ids)
+    if item == "policy_list":
+        return policy_item_deletes("template/policy/list", LIST_MOUNT_POINTS, get_policy_list_ids)
+    return generic_item_deletes(item)
+
+def delete_object(mount_point):
+    """DELETE an object, returns (outcome, response) instead of raising"""
+    try:
+        response = sdwanp.delete_request(mount_point)
+    except CiscoException as e:
+        return "failed", e
+    if response in rest_api_lib.delete_skip_msgs:
+        return "skipped", response
+    return "deleted", response
+
+def delete_items(*tiers):
+    """Delete the objects of the items of each tier
+
+        Tiers are deleted one after the other, so objects are deleted before
+        the ones they reference. The objects of all the items of a tier are
+        deleted concurrently on the asyncio client. A summary of the deleted,
+        skipped (factory default, read-only or partner) and failed objects
+        is printed at the end.
 
-def delete_policy_definitions():
-    print("policy_definition")
+    """
+    summary = OrderedDict((outcome, 0) for outcome in ("deleted", "skipped", "failed"))
+
+    def tier_deletes(tier):
+        for item in tier:
+            yield item, None
+            for id, mount_point in item_deletes(item):
+                yield id, mount_point
+
+    for tier in tiers:
+        with sdwanp.profile.stage("delete " + ", ".join(tier)):
+            deletes = iter_futures((id, sdwanp_async.submit(sdwanp_async.call(delete_object, mount_point)) if mount_point else None)
+                                   for id, mount_point in tier_deletes(tier))
+            for key, result in deletes:
+                if result is None:
+                    print(key)
+                    continue
+                outcome, response = result
+                summary[outcome] += 1
+                print("Deleting ID: {} - {}".format(key, response))
+        print("")
 
-    definition_mount_points =    [
-        "/cflowd",
-        "/dnssecurity",
-        "/advancedMalwareProtection",
-        "/control",
-        "/intrusionprevention",
-        "/vedgeroute",
-        "/hubandspoke",
-        "/acl",
-        "/vpnmembershipgroup",
-        "/approute",
-        "/zonebasedfw",
-        "/urlfiltering",
-        "/qosmap",
-        "/aclv6",
-        "/mesh",
-        "/data",
-        "/rewriterule"
-                                ]
-    for mount_point in definition_mount_points:
-        policy_definition_ids_list = get_policy_definition_ids(mount_point)
-        for id in policy_definition_ids_list:
-            print("Deleting ID: {} - ".format(id), end="")
-            new_mount_point = "template/policy/definition" + str(mount_point)+ "/" + str(id)
-            response = sdwanp.delete_request(new_mount_point)
-            print(response)
+    print("Deleted {deleted}, skipped {skipped} (factory default or read-only), failed {failed}".format(**summary))
     print("")
+    if summary["failed"]:
+        raise CiscoException("Fail - Delete")
 
-def delete_policy_lists():
-    print("policy_list")
 
-    list_mount_points =    [
-      "/community",
-      "/localdomain",
-      "/dataipv6prefix",
-      "/ipv6prefix",
-      "/tloc",
-      "/umbrellasecret",
-      "/aspath",
-      "/zone",
-      "/color",
-      "/sla",
-      "/localapp",
-      "/app",
-      "/mirror",
-      "/dataprefix",
-      "/extcommunity",
-      "/site",
-#      "/ipprefixall"
-      "/prefix",
-      "/umbrelladata",
-      "/class",
-      "/ipssignature",
-#      "/dataprefixall",
-      "/urlblacklist",
-      "/policer",
-      "/urlwhitelist",
-      "/vpn",
-      "/tgapikey"
-                            ]
-    for mount_point in list_mount_points:
-        policy_list_ids_list = get_policy_list_ids(mount_point)
-        for id in policy_list_ids_list:
-            print("Deleting ID: {} - ".format(id), end="")
-            new_mount_point = "template/policy/list" + str(mount_point)+ "/" + str(id)
-            response = sdwanp.delete_request(new_mount_point)
-            print(response)
-    print("")
+def load_device_filter(path):
+    """Chassis and serial numbers listed in path, one per line"""
+    try:
+        with open(path) as f:
+            return set(line.strip() for line in f if line.strip() and not line.startswith("#"))
+    except EnvironmentError: # parent of IOError, OSError
+        raise CiscoException("File {} not found or with errors!".format(path))
 
+def device_selected(*numbers):
+    """Whether the SDWAN_DEVICES filter is unset or lists one of the numbers"""
+    return SDWAN_DEVICES is None or any(number in SDWAN_DEVICES for number in numbers if number)
 
 def device_certificates(validity):
+    """Set the certificate validity of the vEdges
+
+        Devices are sent SDWAN_CHUNK_SIZE at a time in each request, only the
+        ones listed in the SDWAN_DEVICES filter when set. Devices reported as
+        failed by the tasks are printed.
+
+    """
     print("device_certificate")
 
     mount_point = "certificate/vedge/list"
     response = json.loads(sdwanp.get_request(mount_point))
     device_data = response["data"]
-    chassis_serial_list_ids = [(device["chasisNumber"], device["serialNumber"]) for device in device_data]
+    chassis_serial_list_ids = [(device["chasisNumber"], device["serialNumber"]) for device in device_data
+                               if device_selected(device["chasisNumber"], device["serialNumber"])]
 
-    for chasisNumber, serialNumber in chassis_serial_list_ids:
-        print("{}ating certificate chassis ID:{}... ".format(validity, chasisNumber)),
+    def certificate_posts():
         mount_point = "certificate/save/vedge/list"
-        item = [{"chasisNumber" : chasisNumber, "serialNumber" : serialNumber, "validity" : validity}]
-        response = sdwanp.post_request(mount_point, item)
-        print (response)
+        for i in range(0, len(chassis_serial_list_ids), SDWAN_CHUNK_SIZE):
+            chunk = chassis_serial_list_ids[i:i + SDWAN_CHUNK_SIZE]
+            item = [{"chasisNumber" : chasisNumber, "serialNumber" : serialNumber, "validity" : validity} for chasisNumber, serialNumber in chunk]
+            yield chunk, mount_point, item
+
+    tasks = []
+    for chunk, response in iter_posts(certificate_posts()):
+        print("{}ating certificate chassis ID:{} to {} ({} devices)... {}".format(validity, chunk[0][0], chunk[-1][0], len(chunk), response))
+        tasks.append(response)
+    print("")
+
+    failed = [status for status in wait_for_tasks(tasks, None) if str(status.get("statusId", status.get("status", ""))).lower() == "failure"]
+    for status in failed:
+        print("Failed certificate chassis ID:{} - {}".format(status.get("uuid"), status.get("activity", status.get("status"))))
+    print("{}ated {} certificates, {} failed".format(validity, len(chassis_serial_list_ids) - len(failed), len(failed)))
     print("")
 
 def invalidate_certificates():
@@ -615,11 +1621,13 @@ def push_to_controllers():
     item = {}
     response = sdwanp.post_request(mount_point, item)
     print("Push to controllers: {}".format(response))
-    wait(2)
+    wait_for_tasks([response], 2)
 
 def detach_devices():
     """Detach devices.
 
+        Only the devices of the SDWAN_DEVICES filter when set.
+
         Example command:
 
              ./sd-wan-exim.py detach_devices
@@ -634,57 +1642,36 @@ def detach_devices():
     device_data = response["data"]
     template_list_ids = [device["templateId"] for device in device_data]
 
-    need_to_wait = False
-
-    for template_id in template_list_ids:
-        mount_point = "template/device/config/attached/" + str(template_id)
-        response = json.loads(sdwanp.get_request(mount_point))
-        attach_data = response["data"]
-        if attach_data:
-            need_to_wait = True
-            for attach in attach_data:
-                item = {}
-                item["devices"] = []
-                if (attach["personality"] == 'vedge'):
-                    print(attach["personality"], attach["uuid"], attach["deviceIP"])
-                    item["deviceType"] = attach["personality"]
-                    item["devices"].append({"deviceId":attach["uuid"],"deviceIP":attach["deviceIP"]})
-                    response = sdwanp.post_request(mount_point_attach, item)
-
-    if need_to_wait:
-        print("Device vedge templates detached")
-        wait(3)
-    else:
-        print("All device vedge templates are already detached")
-
-    need_to_wait = False
-
-    for template_id in template_list_ids:
-        mount_point = "template/device/config/attached/" + str(template_id)
-        response = json.loads(sdwanp.get_request(mount_point))
-        attach_data = response["data"]
-        if attach_data:
-            need_to_wait = True
-            for attach in attach_data:
-                item = {}
-                item["devices"] = []
-                if (attach["personality"] == 'vsmart'):
-                    print(attach["personality"], attach["uuid"], attach["deviceIP"])
-                    item["deviceType"] = 'controller'
-                    item["devices"].append({"deviceId":attach["uuid"],"deviceIP":attach["deviceIP"]})
-                    response = sdwanp.post_request(mount_point_attach, item)
-
-    if need_to_wait:
-        print("Device vsmart templates detached")
-        wait(2)
-    else:
-        print("All device vsmart templates are already detached")
+    """ Attached devices of every template, fetched once """
+    attached = OrderedDict((personality, []) for personality in ("vedge", "vsmart"))
+    attachments = iter_requests((template_id, "template/device/config/attached/" + str(template_id)) for template_id in template_list_ids)
+    for template_id, response in attachments:
+        for attach in json.loads(response)["data"]:
+            if attach["personality"] in attached and device_selected(attach["uuid"], attach.get("chasisNumber"), attach.get("serialNumber")):
+                attached[attach["personality"]].append(attach)
+
+    """ One detach request per device type, vEdges before vSmarts """
+    for personality, device_type in (("vedge", "vedge"), ("vsmart", "controller")):
+        if attached[personality]:
+            item = {}
+            item["deviceType"] = device_type
+            item["devices"] = []
+            for attach in attached[personality]:
+                print(attach["personality"], attach["uuid"], attach["deviceIP"])
+                item["devices"].append({"deviceId":attach["uuid"],"deviceIP":attach["deviceIP"]})
+            response = sdwanp.post_request(mount_point_attach, item)
+
+            print("Device {} templates detached".format(personality))
+            wait_for_tasks([response], 3 if personality == "vedge" else 2)
+        else:
+            print("All device {} templates are already detached".format(personality))
 
 def deactivate_generic_policy(mount_point):
     response = json.loads(sdwanp.get_request(mount_point))
     device_data = response['data']
     policy_active_ids = [device["policyId"] for device in device_data if device["isPolicyActivated"] == True]
     need_to_wait = False
+    tasks = []
 
     for policy_active_id in policy_active_ids:
         need_to_wait = True
@@ -692,10 +1679,11 @@ def deactivate_generic_policy(mount_point):
         item = {}
         response = sdwanp.post_request(new_mount_point, item)
         print("Deactivated policy:{} - {}".format(policy_active_id, response))
+        tasks.append(response)
 
     if need_to_wait:
         print("Policies deactivated")
-        wait(2)
+        wait_for_tasks(tasks, 2)
     else:
         print("All policies are already deactivated")
 
@@ -714,346 +1702,313 @@ def deactivate_policies():
     #deactivate_generic_policy("template/policy/security")
 
 def check_attached_devices():
+    """Return True if any device is attached to a device template
+
+        The devicesAttached count of the template/device listing is used
+        when present. Templates without it are queried concurrently and the
+        outstanding requests are cancelled on the first attached device.
+
+    """
     print("check_attached_devices")
 
     mount_point = "template/device"
     response = json.loads(sdwanp.get_request(mount_point))
     device_data = response["data"]
-    template_list_ids = [device["templateId"] for device in device_data]
+    if any(device.get("devicesAttached") for device in device_data):
+        return True
+    template_list_ids = [device["templateId"] for device in device_data if "devicesAttached" not in device]
 
-    for template_id in template_list_ids:
-        mount_point = "template/device/config/attached/" + str(template_id)
-        response = json.loads(sdwanp.get_request(mount_point))
-        attach_data = response["data"]
-        if attach_data:
-            return True
+    futures = [sdwanp_async.submit(sdwanp_async.get_request("template/device/config/attached/" + str(template_id)))
+               for template_id in template_list_ids]
+    try:
+        for future in as_completed(futures):
+            attach_data = json.loads(future.result())["data"]
+            if attach_data:
+                return True
+    finally:
+        for future in futures:
+            future.cancel()
 
     return False
 
 
-def import_feature_templates(file_path):
+def collect_new_ids(created, id_key, name_key):
+    """Build the name -> new ID map of the imported objects
+
+        created holds a (listing mount point, composed name, name, response)
+        tuple per posted object. The new ID is taken from the POST response
+        when it carries id_key. Objects skipped as duplicates, and types
+        whose POST returns no body, are looked up by name in their listing,
+        each listing is only fetched when needed and once.
+
+    """
+    id_new = OrderedDict()
+    missing = OrderedDict()
+    for listing, composed_name, name, response in created:
+        if isinstance(response, dict) and id_key in response:
+            id_new[composed_name] = response[id_key]
+        else:
+            missing.setdefault(listing, []).append((composed_name, name))
+    for listing, response_json in iter_requests((listing, listing) for listing in missing):
+        if response_json:
+            listed_ids = {item[name_key]: item[id_key] for item in json.loads(response_json)['data']}
+            for composed_name, name in missing[listing]:
+                if name in listed_ids:
+                    id_new[composed_name] = listed_ids[name]
+    return id_new
+
+def import_feature_templates(tar):
     print("feature_template")
 
-    feature_template_json_file = os.path.join(file_path, "feature_template.json")
-    if not os.path.exists(feature_template_json_file):
+    feature_template_json_file = open_archive_file(tar, "feature_template.json")
+    if not feature_template_json_file:
         print("No feature templates")
         print("")
         return (OrderedDict(), OrderedDict())
-    feature_data = load_json_from_file(feature_template_json_file)
-    feature_template_data = feature_data["configuration"]
+    feature_template_id_old = OrderedDict()
+    created = []
 
-    for item in feature_template_data:
+    def feature_template_posts():
+        for _, item in iter_json_from_file(feature_template_json_file):
 
-        '''
-        if "templateDefinition" in item:
-            if "vrrp" in item["templateDefinition"]:
-                print("ATTENTION: VRRP SKIPPED - Featute Template imported and VRRP set to Empty")
-                item["templateDefinition"]["vrrp"] = {}
-        '''
+            '''
+            if "templateDefinition" in item:
+                if "vrrp" in item["templateDefinition"]:
+                    print("ATTENTION: VRRP SKIPPED - Featute Template imported and VRRP set to Empty")
+                    item["templateDefinition"]["vrrp"] = {}
+            '''
 
-        mount_point = "template/feature/"
-        print("Feature template: Importing {0} - ".format(item["templateName"]), end="")
-        response = sdwanp.post_request(mount_point, item)
-        print("Done, {0}".format(response))
+            mount_point = "template/feature/"
+            if SDWAN_JOURNAL.get("feature_template", item["templateName"]):
+                yield item, None, None
+            else:
+                yield item, mount_point, item
 
-    """ Update Feature IDs """
-    feature_template_id_old = OrderedDict()
-    for item in feature_template_data:
+    for item, response in iter_posts(feature_template_posts()):
+        if response is None:
+            response = {'templateId': SDWAN_JOURNAL.get("feature_template", item["templateName"])}
+            print("Feature template: Resuming {0} - {1}".format(item["templateName"], response['templateId']))
+        else:
+            print("Feature template: Importing {0} - Done, {1}".format(item["templateName"], response))
+            SDWAN_JOURNAL.record_response("feature_template", item["templateName"], response, 'templateId')
+
+        """ Update Feature IDs """
         feature_template_id_old[item['templateId']] = item['templateName']
+        created.append(('template/feature', item['templateName'], item['templateName'], response))
 
-    feature_template_id_new = OrderedDict()
-    response = json.loads(sdwanp.get_request('template/feature'))
-    feature_template_data = response['data']
-    for feature_template_temp in feature_template_data:
-        feature_template_id_new[feature_template_temp['templateName']] = feature_template_temp['templateId']
+    feature_template_id_new = collect_new_ids(created, 'templateId', 'templateName')
+    SDWAN_JOURNAL.record_ids("feature_template", feature_template_id_new, feature_template_id_old.values())
 
     print("")
 
     return (feature_template_id_old, feature_template_id_new)
 
-def import_device_templates(file_path, all_template_ids, all_policy_ids = ([],[],[],[],[],[])):
+def import_device_templates(tar, all_template_ids, *all_policy_ids):
     print("device_template")
 
-    f_t_old, f_t_new = all_template_ids
-    ve_t_old, ve_t_new, vs_t_old, vs_t_new, sec_t_old, sec_t_new = all_policy_ids
-    device_template_json_file = os.path.join(file_path, "device_template.json")
-    if not os.path.exists(device_template_json_file):
+    feature_ids = id_translator(all_template_ids)
+    policy_ids = id_translator(*all_policy_ids)
+    device_template_json_file = open_archive_file(tar, "device_template.json")
+    if not device_template_json_file:
         print("No device templates")
         print("")
         return (OrderedDict(), OrderedDict())
-    device_template = load_json_from_file(device_template_json_file)
-    device_template_data = device_template["configuration"]
-
-    for item in device_template_data:
-        if "configType" in item:
-            if item["configType"] == "template":
-                mount_point = "template/device/feature"
-
-                item["featureTemplateUidRange"] = []
-                try:
-                    del item["templateId"]
-                except:
-                    pass
-
-                """ Update policy IDs """
-                if "policyId" in item:
-                    if item["policyId"] in ve_t_old:
-                        old_aux = ve_t_old[item["policyId"]]
-                        new_aux = ve_t_new[old_aux]
-                        item["policyId"] = new_aux
-                    elif item["policyId"] in vs_t_old:
-                        old_aux = vs_t_old[item["policyId"]]
-                        new_aux = vs_t_new[old_aux]
-                        item["policyId"] = new_aux
-                    elif item["policyId"] in sec_t_old:
-                        old_aux = sec_t_old[item["policyId"]]
-                        new_aux = sec_t_new[old_aux]
-                        item["policyId"] = new_aux
-                    else:
-                        item["policyId"] = ""
-                else:
-                    item["policyId"] = ""
-
-                """ Update security policy IDs """
-                if "securityPolicyId" in item:
-                    if item["securityPolicyId"] in ve_t_old:
-                        old_aux = ve_t_old[item["securityPolicyId"]]
-                        new_aux = ve_t_new[old_aux]
-                        item["securityPolicyId"] = new_aux
-                    elif item["securityPolicyId"] in vs_t_old:
-                        old_aux = vs_t_old[item["securityPolicyId"]]
-                        new_aux = vs_t_new[old_aux]
-                        item["securityPolicyId"] = new_aux
-                    elif item["securityPolicyId"] in sec_t_old:
-                        old_aux = sec_t_old[item["securityPolicyId"]]
-                        new_aux = sec_t_new[old_aux]
-                        item["securityPolicyId"] = new_aux
+
+    """ Resolve the references of every template before importing any """
+    unresolved = OrderedDict()
+    for _, item in iter_json_from_file(open_archive_file(tar, "device_template.json")):
+        if item.get("configType") == "template":
+            references = resolve_device_template(item, feature_ids, policy_ids)
+            if references:
+                unresolved[item["templateName"]] = references
+    for template_name, references in unresolved.items():
+        print("Device template: {0} has unresolved references: {1}".format(template_name, ", ".join(references)))
+
+    def device_template_posts():
+        for _, item in iter_json_from_file(device_template_json_file):
+            if "configType" in item:
+                if item["configType"] == "template":
+                    mount_point = "template/device/feature"
+
+                    if item["templateName"] in unresolved or SDWAN_JOURNAL.get("device_template", item["templateName"]):
+                        yield item, None, None
+                        continue
+
+                    item["featureTemplateUidRange"] = []
+                    try:
+                        del item["templateId"]
+                    except:
+                        pass
+
+                    """ Update policy and feature template IDs """
+                    resolve_device_template(item, feature_ids, policy_ids)
+
+                    if item["deviceType"] == "vbond":
+                        item["deviceType"] = "vedge-cloud"
+
+                    yield item, mount_point, item
+                elif item["configType"] == "file":
+                    try:
+                        del item["templateId"]
+                        del item["feature"]
+                        del item["lastUpdatedBy"]
+                        del item["lastUpdatedOn"]
+                        del item["createdOn"]
+                        del item["createdBy"]
+                        del item["@rid"]
+                    except:
+                        pass
+                    mount_point = "template/device/cli"
+
+                    if item["deviceType"] == "vbond":
+                        item["deviceType"] = "vedge-cloud"
+
+                    if SDWAN_JOURNAL.get("device_template", item["templateName"]):
+                        yield item, None, None
                     else:
-                        item["securityPolicyId"] = ""
+                        yield item, mount_point, item
                 else:
-                    item["securityPolicyId"] = ""
-
-                """ Update generalTemplates IDs """
-                if "generalTemplates" in item:
-                    for i in range(0, len(item["generalTemplates"])):
-                        template_id = item["generalTemplates"][i]["templateId"]
-                        old_aux = f_t_old[template_id]
-                        new_aux = f_t_new[old_aux]
-                        item["generalTemplates"][i]["templateId"] = new_aux
-
-                        """ Update subtemplates generalTemplates IDs """
-                        if "subTemplates" in item["generalTemplates"][i]:
-                            for j in range(0, len(item["generalTemplates"][i]["subTemplates"])):
-                                subtemplate_id = item["generalTemplates"][i]["subTemplates"][j]["templateId"]
-                                old_aux = f_t_old[subtemplate_id]
-                                new_aux = f_t_new[old_aux]
-                                item["generalTemplates"][i]["subTemplates"][j]["templateId"] = new_aux
-
-                                """ Update subsubtemplates generalTemplates IDs """
-                                if "subTemplates" in item["generalTemplates"][i]["subTemplates"][j]:
-                                    for k in range(0, len(item["generalTemplates"][i]["subTemplates"][j]["subTemplates"])):
-                                        subsubtemple_id = item["generalTemplates"][i]["subTemplates"][j]["subTemplates"][k]["templateId"]
-                                        old_aux = f_t_old[subsubtemple_id]
-                                        new_aux = f_t_new[old_aux]
-                                        item["generalTemplates"][i]["subTemplates"][j]["subTemplates"][k]["templateId"] = new_aux
-
-                if item["deviceType"] == "vbond":
-                    item["deviceType"] = "vedge-cloud"
-
-                print("Device template: Importing {0} - ".format(item["templateName"]), end="")
-                response = sdwanp.post_request(mount_point, item)
-                print("Done, {0}".format(response))
-            elif item["configType"] == "file":
-                try:
-                    del item["templateId"]
-                    del item["feature"]
-                    del item["lastUpdatedBy"]
-                    del item["lastUpdatedOn"]
-                    del item["createdOn"]
-                    del item["createdBy"]
-                    del item["@rid"]
-                except:
-                    pass
-                mount_point = "template/device/cli"
-
-                if item["deviceType"] == "vbond":
-                    item["deviceType"] = "vedge-cloud"
-
-                print("Device template: Importing {0} - ".format(item["templateName"]), end="")
-                response = sdwanp.post_request(mount_point, item)
-                print("Done, {0}".format(response))
-            else:
-                print("Device template: {0} is not a template, acutal configType is {1}".format(item["templateName"], item["configType"]))
+                    yield item, None, None
+
+    skipped = []
+    for item, response in iter_posts(device_template_posts()):
+        if item["configType"] not in ("template", "file"):
+            print("Device template: {0} is not a template, acutal configType is {1}".format(item["templateName"], item["configType"]))
+        elif item["templateName"] in unresolved:
+            print("Device template: Skipping {0}, unresolved references".format(item["templateName"]))
+            skipped.append(item["templateName"])
+        elif response is None:
+            print("Device template: Resuming {0} - {1}".format(item["templateName"], SDWAN_JOURNAL.get("device_template", item["templateName"])))
+        else:
+            print("Device template: Importing {0} - Done, {1}".format(item["templateName"], response))
+            SDWAN_JOURNAL.record_response("device_template", item["templateName"], response, 'templateId')
     print("")
 
-def import_policy_lists(file_path):
+    # the import is incomplete, the journal is kept for the rerun
+    if skipped:
+        raise CiscoException("Device templates {} not imported, unresolved references".format(", ".join(skipped)))
+
+def import_policy_lists(tar):
     print("policy_list")
 
-    policy_list_json_file = os.path.join(file_path, "policy_list.json")
-    if not os.path.exists(policy_list_json_file):
+    policy_list_json_file = open_archive_file(tar, "policy_list.json")
+    if not policy_list_json_file:
         print("No policy list")
         print("")
         return (OrderedDict(), OrderedDict())
-    policy_list = load_json_from_file(policy_list_json_file)
-    policy_list_data = policy_list["configuration"]
+    policy_list_id_old = OrderedDict()
+    created = []
 
-    for list in policy_list_data:
-        mount_point = "template/policy/list" + str(list)
+    def policy_list_posts():
+        for list, item in iter_json_from_file(policy_list_json_file):
+            mount_point = "template/policy/list" + str(list)
+            if SDWAN_JOURNAL.get("policy_list", str(list) + "/" + str(item['name'])):
+                yield (list, item), None, None
+            else:
+                yield (list, item), mount_point, item
 
-        for item in policy_list_data[list]:
-            print("Policy list: Importing {0} {1} - ".format(list, item["name"]), end="")
-            response = sdwanp.post_request(mount_point, item)
-            print("Done, {0}".format(response))
-    print("")
+    for (list, item), response in iter_posts(policy_list_posts()):
+        composed_name = str(list) + "/" + str(item['name'])
+        if response is None:
+            response = {'listId': SDWAN_JOURNAL.get("policy_list", composed_name)}
+            print("Policy list: Resuming {0} {1} - {2}".format(list, item["name"], response['listId']))
+        else:
+            print("Policy list: Importing {0} {1} - Done, {2}".format(list, item["name"], response))
+            SDWAN_JOURNAL.record_response("policy_list", composed_name, response, 'listId')
 
-    list_mount_points =    [
-      "/community",
-      "/localdomain",
-      "/dataipv6prefix",
-      "/ipv6prefix",
-      "/tloc",
-      "/umbrellasecret",
-      "/aspath",
-      "/zone",
-      "/color",
-      "/sla",
-      "/localapp",
-      "/app",
-      "/mirror",
-      "/dataprefix",
-      "/extcommunity",
-      "/site",
-#      "/ipprefixall"
-      "/prefix",
-      "/umbrelladata",
-      "/class",
-      "/ipssignature",
-#      "/dataprefixall",
-      "/urlblacklist",
-      "/policer",
-      "/urlwhitelist",
-      "/vpn",
-      "/tgapikey"
-                            ]
-
-    """ Update List IDs """
-    policy_list_id_old = OrderedDict()
-    for list in policy_list_data:
-        for item in policy_list_data[list]:
-            composed_name = str(list) + "/" + str(item['name'])
-            policy_list_id_old[item['listId']] = composed_name
+        """ Update List IDs """
+        policy_list_id_old[item['listId']] = composed_name
+        created.append(('template/policy/list' + str(list), composed_name, item['name'], response))
+    print("")
     #pprint(policy_list_id_old)
 
-    policy_list_id_new = OrderedDict()
-    for mount_point in list_mount_points:
-        response_json = sdwanp.get_request('template/policy/list' + str(mount_point))
-        if response_json:
-            response = json.loads(response_json)
-            policy_list_data = response['data']
-            for policy_list_temp in policy_list_data:
-                policy_list_id_new[str(mount_point) + "/" + str(policy_list_temp['name'])] = policy_list_temp['listId']
+    policy_list_id_new = collect_new_ids(created, 'listId', 'name')
+    SDWAN_JOURNAL.record_ids("policy_list", policy_list_id_new, policy_list_id_old.values())
     #pprint(policy_list_id_new)
 
     return (policy_list_id_old, policy_list_id_new)
 
-def import_policy_definitions(file_path, all_list_ids):
+def import_policy_definitions(tar, all_list_ids):
     print("policy_definition")
 
-    policy_list_id_old, policy_list_id_new = all_list_ids
-    policy_definition_json_file = os.path.join(file_path, "policy_definition.json")
-    if not os.path.exists(policy_definition_json_file):
+    policy_definition_json_file = open_archive_file(tar, "policy_definition.json")
+    if not policy_definition_json_file:
         print("No policy definition")
         print("")
         return (OrderedDict(), OrderedDict())
-    policy_definition = load_json_from_file(policy_definition_json_file)
-    policy_definition_data = policy_definition["configuration"]
-
-    policy_definition_data = update_ids(policy_definition_data, policy_list_id_old, policy_list_id_new)
-
-    for definition in policy_definition_data:
-        mount_point = "template/policy/definition" + str(definition)
+    policy_definition_id_old = OrderedDict()
+    created = []
+    list_ids = id_translator(all_list_ids)
+
+    def policy_definition_posts():
+        for definition, item in iter_json_from_file(policy_definition_json_file):
+            mount_point = "template/policy/definition" + str(definition)
+            if SDWAN_JOURNAL.get("policy_definition", str(definition) + "/" + str(item['name'])):
+                yield (definition, item), None, None
+                continue
+
+            list_ids.translate(item)
+            list_ids.check(item["name"])
+            yield (definition, item), mount_point, item
+
+    for (definition, item), response in iter_posts(policy_definition_posts()):
+        composed_name = str(definition) + "/" + str(item['name'])
+        if response is None:
+            response = {'definitionId': SDWAN_JOURNAL.get("policy_definition", composed_name)}
+            print("Policy definition: Resuming {0} {1} - {2}".format(definition, item["name"], response['definitionId']))
+        else:
+            print("Policy definition: Importing {0} {1} - Done, {2}".format(definition, item["name"], response))
+            SDWAN_JOURNAL.record_response("policy_definition", composed_name, response, 'definitionId')
 
-        for item in policy_definition_data[definition]:
-            print("Policy definition: Importing {0} {1} - ".format(definition, item["name"]), end="")
-            response = sdwanp.post_request(mount_point, item)
-            print("Done, {0}".format(response))
+        """ Update Definition IDs """
+        policy_definition_id_old[item['definitionId']] = composed_name
+        created.append(('template/policy/definition' + str(definition), composed_name, item['name'], response))
     print("")
-
-    definition_mount_points =    [
-        "/cflowd",
-        "/dnssecurity",
-        "/advancedMalwareProtection",
-        "/control",
-        "/intrusionprevention",
-        "/vedgeroute",
-        "/hubandspoke",
-        "/acl",
-        "/vpnmembershipgroup",
-        "/approute",
-        "/zonebasedfw",
-        "/urlfiltering",
-        "/qosmap",
-        "/aclv6",
-        "/mesh",
-        "/data",
-        "/rewriterule"
-                                ]
-
-    """ Update Definition IDs """
-    policy_definition_id_old = OrderedDict()
-    for definition in policy_definition_data:
-        for item in policy_definition_data[definition]:
-            composed_name = str(definition) + "/" + str(item['name'])
-            policy_definition_id_old[item['definitionId']] = composed_name
     #pprint(policy_list_id_old)
 
-    policy_definition_id_new = OrderedDict()
-    for mount_point in definition_mount_points:
-        response_json = sdwanp.get_request('template/policy/definition' + str(mount_point))
-        if response_json:
-            response = json.loads(response_json)
-            policy_definition_data = response['data']
-            for policy_definition_temp in policy_definition_data:
-                policy_definition_id_new[str(mount_point) + "/" + str(policy_definition_temp['name'])] = policy_definition_temp['definitionId']
+    policy_definition_id_new = collect_new_ids(created, 'definitionId', 'name')
+    SDWAN_JOURNAL.record_ids("policy_definition", policy_definition_id_new, policy_definition_id_old.values())
     #pprint(policy_list_id_new)
     return (policy_definition_id_old, policy_definition_id_new)
 
-def import_vedge_policies(file_path, all_list_ids, all_definition_ids):
+def import_vedge_policies(tar, all_list_ids, all_definition_ids):
     print("vedge_policy")
 
-    policy_list_id_old, policy_list_id_new = all_list_ids
-    policy_definition_id_old, policy_definition_id_new = all_definition_ids
-    vedge_policy_json_file = os.path.join(file_path, "vedge_policy.json")
-    vedge_policy_id_json_file = os.path.join(file_path, "vedge_policy_id.json")
-    if not os.path.exists(vedge_policy_json_file):
+    policy_ids = id_translator(all_list_ids, all_definition_ids)
+    vedge_policy_json_file = open_archive_file(tar, "vedge_policy.json")
+    vedge_policy_id_json_file = open_archive_file(tar, "vedge_policy_id.json")
+    if not vedge_policy_json_file:
         print("No vedge policy")
         print("")
         return (OrderedDict(), OrderedDict())
-    vedge_policy = load_json_from_file(vedge_policy_json_file)
-    vedge_policy_data = vedge_policy["configuration"]
+    created = []
 
-    for item in vedge_policy_data:
-        if "policyType" in item:
-            if item["policyType"] == "feature":
-                mount_point = "template/policy/vedge/"
-
-                for i in range(0, len(item["policyDefinition"]["assembly"])):
-                    def_id = item["policyDefinition"]["assembly"][i]["definitionId"]
-                    old_aux_list = policy_definition_id_old[def_id]
-                    new_aux_list = policy_definition_id_new[old_aux_list]
-                    item["policyDefinition"]["assembly"][i]["definitionId"] = new_aux_list
-
-                print("vEdge Policy: Importing {0} - ".format(item["policyName"]), end="")
-                response = sdwanp.post_request(mount_point, item)
-                print("Done, {0}".format(response))
-            elif item["policyType"] == "cli":
+    def vedge_policy_posts():
+        for _, item in iter_json_from_file(vedge_policy_json_file):
+            if "policyType" in item:
                 mount_point = "template/policy/vedge/"
+                if SDWAN_JOURNAL.get("vedge_policy", item["policyName"]):
+                    yield item, None, None
+                elif item["policyType"] == "feature":
+                    policy_ids.translate(item["policyDefinition"])
+                    policy_ids.check(item["policyName"])
+                    yield item, mount_point, item
+                elif item["policyType"] == "cli":
+                    yield item, mount_point, item
+                else:
+                    yield item, None, None
 
-                print("vEdge Policy: Importing {0} - ".format(item["policyName"]), end="")
-                response = sdwanp.post_request(mount_point, item)
-                print("Done, {0}".format(response))
+    for item, response in iter_posts(vedge_policy_posts()):
+        if item["policyType"] in ("feature", "cli"):
+            if response is None:
+                response = {'policyId': SDWAN_JOURNAL.get("vedge_policy", item["policyName"])}
+                print("vEdge Policy: Resuming {0} - {1}".format(item["policyName"], response['policyId']))
             else:
-                print("vEdge Policy: {0} is not a policy, acutal policyType is {1}".format(item["policyName"], item["policyType"]))
+                print("vEdge Policy: Importing {0} - Done, {1}".format(item["policyName"], response))
+                SDWAN_JOURNAL.record_response("vedge_policy", item["policyName"], response, 'policyId')
+            created.append(('template/policy/vedge', item["policyName"], item["policyName"], response))
+        else:
+            print("vEdge Policy: {0} is not a policy, acutal policyType is {1}".format(item["policyName"], item["policyType"]))
     print("")
 
     """ Update vEdge Policy IDs """
@@ -1064,62 +2019,50 @@ def import_vedge_policies(file_path, all_list_ids, all_definition_ids):
         vedge_policy_id_old[item['policyId']] = item['policyName']
     #pprint(vedge_policy_id_old)
 
-    vedge_policy_id_new = OrderedDict()
-    response = json.loads(sdwanp.get_request('template/policy/vedge'))
-    vedge_policy_id_data = response['data']
-    for vedge_policy_id_temp in vedge_policy_id_data:
-        vedge_policy_id_new[vedge_policy_id_temp['policyName']] = vedge_policy_id_temp['policyId']
+    vedge_policy_id_new = collect_new_ids(created, 'policyId', 'policyName')
+    SDWAN_JOURNAL.record_ids("vedge_policy", vedge_policy_id_new, [name for _, _, name, _ in created])
     #pprint(vedge_policy_id_new)
 
     return (vedge_policy_id_old, vedge_policy_id_new)
 
-def import_vsmart_policies(file_path, all_list_ids, all_definition_ids):
+def import_vsmart_policies(tar, all_list_ids, all_definition_ids):
     print("vsmart_policy")
 
-    policy_list_id_old, policy_list_id_new = all_list_ids
-    policy_definition_id_old, policy_definition_id_new = all_definition_ids
-    vsmart_policy_json_file = os.path.join(file_path, "vsmart_policy.json")
-    vsmart_policy_id_json_file = os.path.join(file_path, "vsmart_policy_id.json")
-    if not os.path.exists(vsmart_policy_json_file):
+    policy_ids = id_translator(all_list_ids, all_definition_ids)
+    vsmart_policy_json_file = open_archive_file(tar, "vsmart_policy.json")
+    vsmart_policy_id_json_file = open_archive_file(tar, "vsmart_policy_id.json")
+    if not vsmart_policy_json_file:
         print("No vsmart policy")
         print("")
         return (OrderedDict(), OrderedDict())
-    vedge_policy = load_json_from_file(vsmart_policy_json_file)
-    vsmart_policy_data = vedge_policy["configuration"]
+    created = []
 
-    for item in vsmart_policy_data:
-        if "policyType" in item:
-            if item["policyType"] == "feature":
-                mount_point = "template/policy/vsmart/"
-                for i in range(0, len(item["policyDefinition"]["assembly"])):
-                    def_id = item["policyDefinition"]["assembly"][i]["definitionId"]
-                    old_aux_list = policy_definition_id_old[def_id]
-                    new_aux_list = policy_definition_id_new[old_aux_list]
-                    item["policyDefinition"]["assembly"][i]["definitionId"] = new_aux_list
-                    if "entries" in item["policyDefinition"]["assembly"][i]:
-                        for j in range(0, len(item["policyDefinition"]["assembly"][i]["entries"])):
-                            if "siteLists" in item["policyDefinition"]["assembly"][i]["entries"][j]:
-                                for k in range (0, len(item["policyDefinition"]["assembly"][i]["entries"][j]["siteLists"])):
-                                    site_list = item["policyDefinition"]["assembly"][i]["entries"][j]["siteLists"][k]
-                                    old_aux_list = policy_list_id_old[site_list]
-                                    new_aux_list = policy_list_id_new[old_aux_list]
-                                    item["policyDefinition"]["assembly"][i]["entries"][j]["siteLists"][k] = new_aux_list
-                            if "vpnLists" in item["policyDefinition"]["assembly"][i]["entries"][j]:
-                                for k in range (0, len(item["policyDefinition"]["assembly"][i]["entries"][j]["vpnLists"])):
-                                    vpn_list = item["policyDefinition"]["assembly"][i]["entries"][j]["vpnLists"][k]
-                                    old_aux_list = policy_list_id_old[vpn_list]
-                                    new_aux_list = policy_list_id_new[old_aux_list]
-                                    item["policyDefinition"]["assembly"][i]["entries"][j]["vpnLists"][k] = new_aux_list
-                print("vSmart Policy: Importing {0}  -  ".format(item["policyName"]),  end="")
-                response = sdwanp.post_request(mount_point, item)
-                print("Done, {0}".format(response))
-            elif item["policyType"] == "cli":
+    def vsmart_policy_posts():
+        for _, item in iter_json_from_file(vsmart_policy_json_file):
+            if "policyType" in item:
                 mount_point = "template/policy/vsmart/"
-                print("vSmart Policy: Importing {0} - ".format(item["policyName"]), end="")
-                response = sdwanp.post_request(mount_point, item)
-                print("Done, {0}".format(response))
+                if SDWAN_JOURNAL.get("vsmart_policy", item["policyName"]):
+                    yield item, None, None
+                elif item["policyType"] == "feature":
+                    policy_ids.translate(item["policyDefinition"])
+                    policy_ids.check(item["policyName"])
+                    yield item, mount_point, item
+                elif item["policyType"] == "cli":
+                    yield item, mount_point, item
+                else:
+                    yield item, None, None
+
+    for item, response in iter_posts(vsmart_policy_posts()):
+        if item["policyType"] in ("feature", "cli"):
+            if response is None:
+                response = {'policyId': SDWAN_JOURNAL.get("vsmart_policy", item["policyName"])}
+                print("vSmart Policy: Resuming {0} - {1}".format(item["policyName"], response['policyId']))
             else:
-                print("vSmart Policy: {0} is not a policy, acutal policyType is {1}".format(item["policyName"], item["policyType"]))
+                print("vSmart Policy: Importing {0} - Done, {1}".format(item["policyName"], response))
+                SDWAN_JOURNAL.record_response("vsmart_policy", item["policyName"], response, 'policyId')
+            created.append(('template/policy/vsmart', item["policyName"], item["policyName"], response))
+        else:
+            print("vSmart Policy: {0} is not a policy, acutal policyType is {1}".format(item["policyName"], item["policyType"]))
     print("")
 
     """ Update vSmart Policy IDs """
@@ -1130,51 +2073,50 @@ def import_vsmart_policies(file_path, all_list_ids, all_definition_ids):
         vsmart_policy_id_old[item['policyId']] = item['policyName']
     #pprint(vsmart_policy_id_old)
 
-    vsmart_policy_id_new = OrderedDict()
-    response = json.loads(sdwanp.get_request('template/policy/vsmart'))
-    vsmart_policy_id_data = response['data']
-    for vsmart_policy_id_temp in vsmart_policy_id_data:
-        vsmart_policy_id_new[vsmart_policy_id_temp['policyName']] = vsmart_policy_id_temp['policyId']
+    vsmart_policy_id_new = collect_new_ids(created, 'policyId', 'policyName')
+    SDWAN_JOURNAL.record_ids("vsmart_policy", vsmart_policy_id_new, [name for _, _, name, _ in created])
     #pprint(vsmart_policy_id_new)
 
     return (vsmart_policy_id_old, vsmart_policy_id_new)
 
-def import_security_policies(file_path, all_list_ids, all_definition_ids):
+def import_security_policies(tar, all_list_ids, all_definition_ids):
     print("security_policy")
 
-    policy_list_id_old, policy_list_id_new = all_list_ids
-    policy_definition_id_old, policy_definition_id_new = all_definition_ids
-    security_policy_json_file = os.path.join(file_path, "security_policy.json")
-    security_policy_id_json_file = os.path.join(file_path, "security_policy_id.json")
-    if not os.path.exists(security_policy_json_file):
+    policy_ids = id_translator(all_list_ids, all_definition_ids)
+    security_policy_json_file = open_archive_file(tar, "security_policy.json")
+    security_policy_id_json_file = open_archive_file(tar, "security_policy_id.json")
+    if not security_policy_json_file:
         print("No security policy")
         print("")
         return (OrderedDict(), OrderedDict())
-    security_policy = load_json_from_file(security_policy_json_file)
-    security_policy_data = security_policy["configuration"]
+    created = []
 
-    for item in security_policy_data:
-        if "policyType" in item:
-            if item["policyType"] == "feature":
-                mount_point = "template/policy/security/"
-
-                for i in range(0, len(item["policyDefinition"]["assembly"])):
-                    def_id = item["policyDefinition"]["assembly"][i]["definitionId"]
-                    old_aux_list = policy_definition_id_old[def_id]
-                    new_aux_list = policy_definition_id_new[old_aux_list]
-                    item["policyDefinition"]["assembly"][i]["definitionId"] = new_aux_list
-
-                print("security Policy: Importing {0} - ".format(item["policyName"]), end="")
-                response = sdwanp.post_request(mount_point, item)
-                print("Done, {0}".format(response))
-            elif item["policyType"] == "cli":
+    def security_policy_posts():
+        for _, item in iter_json_from_file(security_policy_json_file):
+            if "policyType" in item:
                 mount_point = "template/policy/security/"
+                if SDWAN_JOURNAL.get("security_policy", item["policyName"]):
+                    yield item, None, None
+                elif item["policyType"] == "feature":
+                    policy_ids.translate(item["policyDefinition"])
+                    policy_ids.check(item["policyName"])
+                    yield item, mount_point, item
+                elif item["policyType"] == "cli":
+                    yield item, mount_point, item
+                else:
+                    yield item, None, None
 
-                print("security Policy: Importing {0} - ".format(item["policyName"]), end="")
-                response = sdwanp.post_request(mount_point, item)
-                print("Done, {0}".format(response))
+    for item, response in iter_posts(security_policy_posts()):
+        if item["policyType"] in ("feature", "cli"):
+            if response is None:
+                response = {'policyId': SDWAN_JOURNAL.get("security_policy", item["policyName"])}
+                print("security Policy: Resuming {0} - {1}".format(item["policyName"], response['policyId']))
             else:
-                print("security Policy: {0} is not a policy, acutal policyType is {1}".format(item["policyName"], item["policyType"]))
+                print("security Policy: Importing {0} - Done, {1}".format(item["policyName"], response))
+                SDWAN_JOURNAL.record_response("security_policy", item["policyName"], response, 'policyId')
+            created.append(('template/policy/security', item["policyName"], item["policyName"], response))
+        else:
+            print("security Policy: {0} is not a policy, acutal policyType is {1}".format(item["policyName"], item["policyType"]))
     print("")
 
     """ Update security Policy IDs """
@@ -1185,17 +2127,14 @@ def import_security_policies(file_path, all_list_ids, all_definition_ids):
         security_policy_id_old[item['policyId']] = item['policyName']
     #pprint(security_policy_id_old)
 
-    security_policy_id_new = OrderedDict()
-    response = json.loads(sdwanp.get_request('template/policy/security'))
-    security_policy_id_data = response['data']
-    for security_policy_id_temp in security_policy_id_data:
-        security_policy_id_new[security_policy_id_temp['policyName']] = security_policy_id_temp['policyId']
+    security_policy_id_new = collect_new_ids(created, 'policyId', 'policyName')
+    SDWAN_JOURNAL.record_ids("security_policy", security_policy_id_new, [name for _, _, name, _ in created])
     #pprint(security_policy_id_new)
 
     return (security_policy_id_old, security_policy_id_new)
 
 
-def export(archive_path):
+def export(archive_path, previous_archive_path=None):
     """Export
             - device templates
             - feature templates
@@ -1204,66 +2143,153 @@ def export(archive_path):
             - policy definitions
             - policy lists
 
-        Data is exported as JSON in a separate folder called configuration.
+        Data is exported as JSON into the configuration archive.
+
+        With a previous archive only the objects that changed since are
+        fetched, the others are copied from the previous archive.
 
         Example command:
 
             ./sd-wan-exim.py export
+            ./sd-wan-exim.py export -since config_archive.tar.gz
 
     """
 
-    file_path = os.path.join(DIR_PATH, "configuration")
-    if os.path.exists(file_path):
-        shutil.rmtree(file_path)
-    os.makedirs(file_path)
+    previous = None
+    if previous_archive_path:
+        previous = previous_export(previous_archive_path)
 
-    export_generic_item(file_path, "device_template", "template/device/object")
-    print("Successfully exported the device templates from %s"%(SDWAN_IP))
-    print("")
+    # the archive replaces the previous one only once complete
+    part_path = "{}.{}.part".format(archive_path, os.getpid())
+    tar = tarfile.open(part_path, "w:gz")
 
-    export_generic_item(file_path, "feature_template", "template/feature/object")
-    print("Successfully exported the feature templates from %s"%(SDWAN_IP))
-    print("")
+    try:
+        versions = OrderedDict()
 
-    export_generic_item(file_path, "vedge_policy", "template/policy/vedge/definition")
-    print("Successfully exported the vEdge policies from %s"%(SDWAN_IP))
-    print("")
+        with sdwanp.profile.stage("export device_template"):
+            versions["device_template"] = export_generic_item(tar, "device_template", "template/device/object", previous)
+        print("Successfully exported the device templates from %s"%(SDWAN_IP))
+        print("")
 
-    export_generic_item(file_path, "vsmart_policy", "template/policy/vsmart/definition")
-    print("Successfully exported the vSmart policies from %s"%(SDWAN_IP))
-    print("")
+        with sdwanp.profile.stage("export feature_template"):
+            versions["feature_template"] = export_generic_item(tar, "feature_template", "template/feature/object", previous)
+        print("Successfully exported the feature templates from %s"%(SDWAN_IP))
+        print("")
 
-    export_generic_item(file_path, "security_policy", "template/policy/security/definition")
-    print("Successfully exported the security policies from %s"%(SDWAN_IP))
-    print("")
+        with sdwanp.profile.stage("export vedge_policy"):
+            versions["vedge_policy"] = export_generic_item(tar, "vedge_policy", "template/policy/vedge/definition", previous)
+        print("Successfully exported the vEdge policies from %s"%(SDWAN_IP))
+        print("")
 
-    export_generic_policy_ids(file_path, "vedge_policy_id", "template/policy/vedge")
-    print("Successfully exported the vEdge policy IDs from %s"%(SDWAN_IP))
-    print("")
+        with sdwanp.profile.stage("export vsmart_policy"):
+            versions["vsmart_policy"] = export_generic_item(tar, "vsmart_policy", "template/policy/vsmart/definition", previous)
+        print("Successfully exported the vSmart policies from %s"%(SDWAN_IP))
+        print("")
 
-    export_generic_policy_ids(file_path, "vsmart_policy_id", "template/policy/vsmart")
-    print("Successfully exported the vSmart policy IDs from %s"%(SDWAN_IP))
-    print("")
+        with sdwanp.profile.stage("export security_policy"):
+            versions["security_policy"] = export_generic_item(tar, "security_policy", "template/policy/security/definition", previous)
+        print("Successfully exported the security policies from %s"%(SDWAN_IP))
+        print("")
 
-    export_generic_policy_ids(file_path, "security_policy_id", "template/policy/security")
-    print("Successfully exported the security policy IDs from %s"%(SDWAN_IP))
-    print("")
+        with sdwanp.profile.stage("export vedge_policy_id"):
+            export_generic_policy_ids(tar, "vedge_policy_id", "template/policy/vedge")
+        print("Successfully exported the vEdge policy IDs from %s"%(SDWAN_IP))
+        print("")
 
-    export_policy_definitions(file_path)
-    print("Successfully exported the policy definitions from %s"%(SDWAN_IP))
-    print("")
+        with sdwanp.profile.stage("export vsmart_policy_id"):
+            export_generic_policy_ids(tar, "vsmart_policy_id", "template/policy/vsmart")
+        print("Successfully exported the vSmart policy IDs from %s"%(SDWAN_IP))
+        print("")
 
-    export_policy_lists(file_path)
-    print("Successfully exported the policy lists from %s"%(SDWAN_IP))
-    print("")
+        with sdwanp.profile.stage("export security_policy_id"):
+            export_generic_policy_ids(tar, "security_policy_id", "template/policy/security")
+        print("Successfully exported the security policy IDs from %s"%(SDWAN_IP))
+        print("")
 
-    print("Successfully exported the configuration from %s"%(SDWAN_IP))
+        with sdwanp.profile.stage("export policy_definition"):
+            for mount_point, versions_list in export_policy_definitions(tar, previous).items():
+                versions["policy_definition" + str(mount_point)] = versions_list
+        print("Successfully exported the policy definitions from %s"%(SDWAN_IP))
+        print("")
+
+        with sdwanp.profile.stage("export policy_list"):
+            for mount_point, versions_list in export_policy_lists(tar, previous).items():
+                versions["policy_list" + str(mount_point)] = versions_list
+        print("Successfully exported the policy lists from %s"%(SDWAN_IP))
+        print("")
+
+        with create_archive_file(tar, VERSION_FILE) as f:
+            json.dump(OrderedDict({"configuration": versions}), f)
+
+        print("Successfully exported the configuration from %s"%(SDWAN_IP))
+
+        tar.close()
+    except BaseException:
+        # no partial archive left behind by a failed export
+        try:
+            tar.close()
+        finally:
+            os.remove(part_path)
+        raise
+    finally:
+        if previous is not None:
+            previous.close()
+    os.replace(part_path, archive_path)
+
+def tenant_archive_path(archive_path, tenant):
+    """Archive of a tenant, next to archive_path and prefixed with the tenant name"""
+    return os.path.join(os.path.dirname(archive_path), "{}_{}".format(tenant, os.path.basename(archive_path)))
+
+def export_tenant(output, tenant, vsessionid, archive_path, previous_archive_path=None):
+    """Export as the tenant of vsessionid, returns the seconds it took
+
+        The output lines are prefixed with the tenant name.
+
+    """
+    start = time.monotonic()
+    with output.stage(tenant), sdwanp.profile.stage("export " + os.path.basename(archive_path)):
+        sdwanp.as_tenant(vsessionid, export, archive_path, previous_archive_path)
+    return time.monotonic() - start
+
+def export_all_tenants(archive_path, previous_archive_path=None):
+    """Export every tenant of a multi-tenant vManage
 
-    tar = tarfile.open(archive_path, "w:gz")
-    for file_name in glob.glob(os.path.join(file_path, "*")):
-        tar.add(file_name, os.path.basename(file_name))
-    tar.close()
-    shutil.rmtree(file_path)
+        Logged in as provider, each tenant is exported with its own
+        VSessionId to its own archive, prefixed with the tenant name. Tenants
+        are exported concurrently, -workers at a time, and share the session
+        and its connection pool. The output of each tenant is prefixed with
+        its name. With a previous archive, the previous
+        archive of each tenant is prefixed the same way.
+
+        Example command:
+
+            ./sd-wan-exim.py export -all-tenants -workers 8
+
+    """
+    vsessionids = sdwanp.tenant_session_ids()
+    print("Exporting {} tenants, {} at a time".format(len(vsessionids), SDWAN_WORKERS))
+    print("")
+
+    futures = OrderedDict()
+    output = stage_output(sys.stdout)
+    with redirect_stdout(output), ThreadPoolExecutor(max_workers=SDWAN_WORKERS) as executor:
+        for tenant, vsessionid in vsessionids.items():
+            previous = tenant_archive_path(previous_archive_path, tenant) if previous_archive_path else None
+            # tenants added since the previous export are exported in full
+            if previous and not os.path.exists(previous):
+                previous = None
+            futures[tenant] = executor.submit(export_tenant, output, tenant, vsessionid, tenant_archive_path(archive_path, tenant), previous)
+
+    failed = []
+    print("Report:")
+    for tenant, future in futures.items():
+        try:
+            print("{:<16} {:>9.1f}s  {}".format(tenant, future.result(), tenant_archive_path(archive_path, tenant)))
+        except Exception as e:
+            print("{:<16} failed: {}".format(tenant, e))
+            failed.append(tenant)
+    if failed:
+        raise CiscoException("Export of tenants {} failed".format(", ".join(failed)))
 
 
 def clean_templates():
@@ -1281,8 +2307,7 @@ def clean_templates():
         if (ask.lower() != "yes"):
             sys.exit("Action stopped - clean templates")
 
-    delete_generic_item("device_template")
-    delete_generic_item("feature_template")
+    delete_items(["device_template"], ["feature_template"])
 
 def clean_policies():
     """Delete policies, definitions and lists.
@@ -1297,18 +2322,19 @@ def clean_policies():
         if (ask.lower() != "yes"):
             sys.exit("Action stopped - clean policies")
 
-    delete_generic_item("vedge_policy")
-    delete_generic_item("vsmart_policy")
-    delete_generic_item("security_policy")
-    delete_policy_definitions()
-    delete_policy_lists()
+    delete_items(["vedge_policy", "vsmart_policy", "security_policy"], ["policy_definition"], ["policy_list"])
 
 def clean_devices():
     """Invalidate certificates and delete system devices.
 
+        With -devices only the listed devices are detached, invalidated and
+        deleted, and the policies, which apply to the whole overlay, are
+        left active.
+
         Example command:
 
             ./sd-wan-exim.py clean_devices
+            ./sd-wan-exim.py clean_devices -devices devices.txt
 
     """
     if check_attached_devices():
@@ -1316,11 +2342,14 @@ def clean_devices():
         if (ask.lower() != "yes"):
             sys.exit("Action stopped - clean devices")
 
-    deactivate_policies()
+    if SDWAN_DEVICES is None:
+        deactivate_policies()
+    else:
+        print("Policies left active, only {} listed devices are cleaned".format(len(SDWAN_DEVICES)))
     detach_devices()
     invalidate_certificates()
     push_to_controllers()
-    delete_generic_item("system_device")
+    delete_items(["system_device"])
 
 def clean():
     """Delete templates and policies configuration.
@@ -1337,13 +2366,107 @@ def clean():
         if (ask.lower() != "yes"):
             sys.exit("Action stopped - clean")
 
-    delete_generic_item("device_template")
-    delete_generic_item("feature_template")
-    delete_generic_item("vedge_policy")
-    delete_generic_item("vsmart_policy")
-    delete_generic_item("security_policy")
-    delete_policy_definitions()
-    delete_policy_lists()
+    delete_items(["device_template"],
+                 ["feature_template", "vedge_policy", "vsmart_policy", "security_policy"],
+                 ["policy_definition"],
+                 ["policy_list"])
+
+
+IMPORT_STAGES = OrderedDict([
+    ("policy_list", (import_policy_lists, ())),
+    ("policy_definition", (import_policy_definitions, ("policy_list",))),
+    ("vedge_policy", (import_vedge_policies, ("policy_list", "policy_definition"))),
+    ("vsmart_policy", (import_vsmart_policies, ("policy_list", "policy_definition"))),
+    ("security_policy", (import_security_policies, ("policy_list", "policy_definition"))),
+    ("feature_template", (import_feature_templates, ())),
+    ("device_template", (import_device_templates, ("feature_template", "vedge_policy", "vsmart_policy", "security_policy"))),
+])
+
+def open_archive(archive_path):
+    try:
+        return tarfile.open(archive_path)
+    except EnvironmentError: # parent of IOError, OSError
+        raise CiscoException("File {} not found or with errors!".format(archive_path))
+
+class stage_output:
+    """stdout of parallel stages, every line prefixed with the stage printing it
+
+        Lines are written whole, so the lines of stages running at the same
+        time do not mix. Threads outside a stage print unchanged. Import
+        stages and the tenants of export -all-tenants are such stages.
+
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        """Prefix the lines printed by the calling thread with name"""
+        self.local.stage = name
+        self.local.line = ""
+        try:
+            yield
+        finally:
+            if self.local.line:
+                self.write("\n")
+            self.local.stage = None
+
+    def write(self, text):
+        stage = getattr(self.local, "stage", None)
+        if stage is None:
+            with self.lock:
+                return self.stream.write(text)
+        lines = (self.local.line + text).split("\n")
+        self.local.line = lines.pop()
+        if lines:
+            with self.lock:
+                self.stream.write("".join("[{}] {}\n".format(stage, line) if line else "\n" for line in lines))
+        return len(text)
+
+    def flush(self):
+        with self.lock:
+            self.stream.flush()
+
+def run_stage(output, archive_path, name, stage, dependencies):
+    tar = open_archive(archive_path)
+    try:
+        with output.stage(name), sdwanp.profile.stage("import " + name):
+            return stage(tar, *dependencies)
+    finally:
+        tar.close()
+
+def run_stages(archive_path, stage_names):
+    """Run the import stages of stage_names as soon as their dependencies are done
+
+        IMPORT_STAGES maps every stage to its import function and to the
+        stages whose (id_old, id_new) results it takes, dependencies outside
+        stage_names are left out. Independent stages run in parallel threads,
+        each on its own handle of the archive, and their objects are posted
+        on the asyncio client. Their output lines are prefixed with the stage
+        name. Returns the results of the stages.
+
+    """
+    stages = OrderedDict((name, IMPORT_STAGES[name]) for name in stage_names)
+    results = OrderedDict()
+    running = {}
+    output = stage_output(sys.stdout)
+    with redirect_stdout(output), ThreadPoolExecutor(max_workers=len(stages)) as executor:
+        while stages or running:
+            for name, (stage, dependencies) in list(stages.items()):
+                dependencies = [dependency for dependency in dependencies if dependency in stage_names]
+                if all(dependency in results for dependency in dependencies):
+                    del stages[name]
+                    future = executor.submit(run_stage, output, archive_path, name, stage, [results[dependency] for dependency in dependencies])
+                    running[future] = name
+            if not running:
+                raise CiscoException("Import stages {} cannot run".format(", ".join(stages)))
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                results[running.pop(future)] = future.result()
+    SDWAN_JOURNAL.complete()
+    return results
 
 
 def configure_templates(archive_path):
@@ -1356,22 +2479,8 @@ def configure_templates(archive_path):
     """
 
     #archive_path = os.path.join(DIR_PATH, CONFIG_ARCH)
-    try:
-        tar = tarfile.open(archive_path)
-    except EnvironmentError: # parent of IOError, OSError
-        raise CiscoException("File {} not found or with errors!".format(archive_path))
-
-    file_path = os.path.join(os.getcwd(), "configuration")
-    if os.path.exists(file_path):
-        shutil.rmtree(file_path)
-    os.makedirs(file_path)
-    tar.extractall(path=file_path)
-    tar.close()
+    run_stages(archive_path, ("feature_template", "device_template"))
 
-    all_template_ids = import_feature_templates(file_path)
-    import_device_templates(file_path, all_template_ids)
-
-    shutil.rmtree(file_path)
     print("Successfully imported the templates to %s"%(SDWAN_IP))
     print("")
 
@@ -1388,31 +2497,12 @@ def configure_policies(archive_path):
     """
 
     #archive_path = os.path.join(DIR_PATH, CONFIG_ARCH)
-    try:
-        tar = tarfile.open(archive_path)
-    except EnvironmentError: # parent of IOError, OSError
-        raise CiscoException("File {} not found or with errors!".format(archive_path))
-
-
-    file_path = os.path.join(os.getcwd(), "configuration")
-    if os.path.exists(file_path):
-        shutil.rmtree(file_path)
-    os.makedirs(file_path)
-    tar.extractall(path=file_path)
-    tar.close()
+    results = run_stages(archive_path, ("policy_list", "policy_definition", "vedge_policy", "vsmart_policy", "security_policy"))
 
-    all_list_ids = import_policy_lists(file_path)
-    all_definition_ids = import_policy_definitions(file_path, all_list_ids)
-    all_vedge_ids = import_vedge_policies(file_path, all_list_ids, all_definition_ids)
-    all_vsmart_ids = import_vsmart_policies(file_path, all_list_ids, all_definition_ids)
-    all_security_ids = import_security_policies(file_path, all_list_ids, all_definition_ids)
-
-    vedge_policy_id_old, vedge_policy_id_new = all_vedge_ids
-    vsmart_policy_id_old, vsmart_policy_id_new = all_vsmart_ids
-    security_policy_id_old, security_policy_id_new = all_security_ids
+    vedge_policy_id_old, vedge_policy_id_new = results["vedge_policy"]
+    vsmart_policy_id_old, vsmart_policy_id_new = results["vsmart_policy"]
     all_policy_ids = (vedge_policy_id_old, vedge_policy_id_new, vsmart_policy_id_old, vsmart_policy_id_new)
 
-    shutil.rmtree(file_path)
     print("Successfully imported the policies to %s"%(SDWAN_IP))
     print("")
 
@@ -1421,6 +2511,9 @@ def configure_policies(archive_path):
 def configure(archive_path):
     """Import configuration.
 
+        Stages run in the order of their dependencies, feature templates
+        are imported while the policies are.
+
         TO DO: Update site ids in definitions and
                Add security policies
 
@@ -1431,33 +2524,8 @@ def configure(archive_path):
     """
 
     #archive_path = os.path.join(DIR_PATH, CONFIG_ARCH)
-    try:
-        tar = tarfile.open(archive_path)
-    except EnvironmentError: # parent of IOError, OSError
-        raise CiscoException("File {} not found or with errors!".format(archive_path))
-
-    file_path = os.path.join(os.getcwd(), "configuration")
-    if os.path.exists(file_path):
-        shutil.rmtree(file_path)
-    os.makedirs(file_path)
-    tar.extractall(path=file_path)
-    tar.close()
-
-    all_list_ids = import_policy_lists(file_path)
-    all_definition_ids = import_policy_definitions(file_path, all_list_ids)
-    all_vedge_ids = import_vedge_policies(file_path, all_list_ids, all_definition_ids)
-    all_vsmart_ids = import_vsmart_policies(file_path, all_list_ids, all_definition_ids)
-    all_security_ids = import_security_policies(file_path, all_list_ids, all_definition_ids)
+    run_stages(archive_path, IMPORT_STAGES)
 
-    vedge_policy_id_old, vedge_policy_id_new = all_vedge_ids
-    vsmart_policy_id_old, vsmart_policy_id_new = all_vsmart_ids
-    security_policy_id_old, security_policy_id_new = all_security_ids
-    all_policy_ids = (vedge_policy_id_old, vedge_policy_id_new, vsmart_policy_id_old, vsmart_policy_id_new, security_policy_id_old, security_policy_id_new)
-
-    all_template_ids = import_feature_templates(file_path)
-    import_device_templates(file_path, all_template_ids, all_policy_ids)
-
-    shutil.rmtree(file_path)
     print("Successfully imported the policies and templates to %s"%(SDWAN_IP))
     print("")
 
@@ -1513,85 +2581,287 @@ def add_user():
         print("User {} created.".format(vusername))
 
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description = __doc__, formatter_class=argparse.RawTextHelpFormatter)
-    parser.add_argument('vManage', help='vManage IP address or DNS name')
-    parser.add_argument('username', help='Username to login the vManage')
-    parser.add_argument('password', help='Password to login the vManage')
-    parser.add_argument('action', help='Action to execute on the vManage')
-    parser.add_argument('configfile', default=CONFIG_ARCH, nargs='?', help='Optional, specific export and import archive name')
-    parser.add_argument('-tenant', '--tenant', required=False, help='Specify tenant in multi-tenant setup')
-    args = parser.parse_args()
-
-    SDWAN_IP = args.vManage
-    SDWAN_USERNAME = args.username
-    SDWAN_PASSWORD = args.password
-    SDWAN_ACTION = args.action
-
-    SDWAN_FILE = args.configfile
-    SDWAN_TENANT = args.tenant
-
-    if SDWAN_IP is None or SDWAN_USERNAME is None or SDWAN_PASSWORD is None or SDWAN_ACTION is None:
-        print("CISCO SDWAN details must be provided before running.")
-        print(__doc__)
-        print("")
-        exit("1")
-
-    SDWAN_CONFIG = os.path.join(DIR_PATH, SDWAN_FILE)
-
-    sdwanp = rest_api_lib(SDWAN_IP, SDWAN_USERNAME, SDWAN_PASSWORD)
-
-    if SDWAN_TENANT:
-        sdwanp.use_tenant(SDWAN_TENANT)
-
-    if SDWAN_ACTION == "clean":
+def run_action(action):
+    """Run an action against the vManage of sdwanp"""
+    if action == "clean":
         action_print("clean                     Delete templates and policies configuration.")
         clean()
-    elif SDWAN_ACTION == "clean_devices":
+    elif action == "clean_devices":
         action_print("clean_devices             Delete certificates and system devices.")
         clean_devices()
-    elif SDWAN_ACTION == "clean_policies":
+    elif action == "clean_policies":
         action_print("clean_policies            Delete policies, definitions and lists.")
         clean_policies()
-    elif SDWAN_ACTION == "clean_templates":
+    elif action == "clean_templates":
         action_print("clean_templates           Delete device and feature templates.")
         clean_templates()
 
-    elif SDWAN_ACTION == "configure":
+    elif action == "configure":
         action_print("configure                 Import entire configuration.")
         configure(SDWAN_CONFIG)
-    elif SDWAN_ACTION == "configure_policies":
+    elif action == "configure_policies":
         action_print("configure_policies        Import vEdge/Vsmart policies, definitions and lists.")
         configure_policies(SDWAN_CONFIG)
-    elif SDWAN_ACTION == "configure_templates":
+    elif action == "configure_templates":
         action_print("configure_templates       Import feature templates and device templates.")
         configure_templates(SDWAN_CONFIG)
 
-    elif SDWAN_ACTION == "export":
+    elif action == "export":
         action_print("export                    Export entire configuration.")
-        export(SDWAN_CONFIG)
+        if SDWAN_ALL_TENANTS:
+            export_all_tenants(SDWAN_CONFIG, SDWAN_SINCE)
+        else:
+            export(SDWAN_CONFIG, SDWAN_SINCE)
 
-    elif SDWAN_ACTION == "password":
+    elif action == "password":
         action_print("password                  Update user password.")
         update_password()
-    elif SDWAN_ACTION == "add_user":
+    elif action == "add_user":
         action_print("add_user                  Add user.")
         add_user()
 
-    elif SDWAN_ACTION == "invalidate_certificates":
+    elif action == "invalidate_certificates":
         action_print("invalidate_certificates   Invalidate device certificates.")
         invalidate_certificates()
-    elif SDWAN_ACTION == "validate_certificates":
+    elif action == "validate_certificates":
         action_print("validate_certificates     Validate device certificates.")
         validate_certificates()
-    elif SDWAN_ACTION == "push_to_controllers":
+    elif action == "push_to_controllers":
         action_print("push_to_controllers       Push configuration to controllers.")
         push_to_controllers()
-    elif SDWAN_ACTION == "detach_devices":
+    elif action == "detach_devices":
         action_print("detach_devices            Detach device templates.")
         detach_devices()
-    elif SDWAN_ACTION == "deactivate_policies":
+    elif action == "deactivate_policies":
         action_print("deactivate_policies       Deactivate policies.")
         deactivate_policies()
     else:
         print(__doc__)
+
+def print_run_stats():
+    """Print the connection, cache and profile statistics of the run"""
+    print(sdwanp.pool_stats())
+    if SDWAN_CACHE:
+        print(sdwanp.cache_stats())
+    if SDWAN_PROFILE:
+        print("")
+        print(sdwanp.profile.report())
+    if SDWAN_PROFILE_JSON:
+        with open(SDWAN_PROFILE_JSON, "w") as f:
+            json.dump(OrderedDict([("vmanage", SDWAN_IP), ("tenant", SDWAN_TENANT or ""), ("action", SDWAN_ACTION)],
+                                  **sdwanp.profile.summary()), f, indent=4)
+
+def load_inventory(path):
+    """Controllers of an inventory CSV file
+
+        Columns are host, credentials, tenant, archive and since, the last
+        three optional. credentials names the environment variables holding
+        the login, <credentials>_USERNAME and <credentials>_PASSWORD.
+        Controllers whose login is not set keep the error, they are reported
+        as failed without stopping the others.
+
+    """
+    try:
+        with open(path) as f:
+            rows = [row for row in csv.DictReader(f) if row.get("host") and not row["host"].startswith("#")]
+    except EnvironmentError: # parent of IOError, OSError
+        raise CiscoException("File {} not found or with errors!".format(path))
+
+    controllers = []
+    for row in rows:
+        credentials = (row.get("credentials") or "").strip()
+        username = os.environ.get(credentials + "_USERNAME")
+        password = os.environ.get(credentials + "_PASSWORD")
+        error = None
+        if not credentials or username is None or password is None:
+            error = "credentials {}_USERNAME/{}_PASSWORD not set".format(credentials, credentials)
+        host = row["host"].strip()
+        tenant = (row.get("tenant") or "").strip() or None
+        archive = (row.get("archive") or "").strip()
+        if not archive:
+            archive = "_".join(name for name in (host.replace(":", "_"), tenant, CONFIG_ARCH) if name)
+        controllers.append(OrderedDict([("host", host), ("username", username), ("password", password), ("tenant", tenant),
+                                        ("archive", archive), ("since", (row.get("since") or "").strip() or None), ("error", error)]))
+    return controllers
+
+def run_controller(controller, settings):
+    """Run the action against one controller of the inventory, in a pool process
+
+        settings holds the SDWAN_* options shared by all the controllers.
+        The output goes to the log file of the controller, next to its
+        archive. Returns the result of the controller for the report.
+
+    """
+    global SDWAN_IP, SDWAN_USERNAME, SDWAN_PASSWORD, SDWAN_TENANT, SDWAN_CONFIG, SDWAN_SINCE, SDWAN_JOURNAL, SDWAN_PROFILE_JSON, sdwanp, sdwanp_async
+    globals().update(settings)
+    SDWAN_IP = controller["host"]
+    SDWAN_USERNAME = controller["username"]
+    SDWAN_PASSWORD = controller["password"]
+    SDWAN_TENANT = controller["tenant"]
+    SDWAN_CONFIG = os.path.join(DIR_PATH, controller["archive"])
+    SDWAN_SINCE = os.path.join(DIR_PATH, controller["since"]) if controller["since"] else None
+    SDWAN_JOURNAL = import_journal(settings["SDWAN_JOURNAL_PATH"], "{}/{}".format(SDWAN_IP, SDWAN_TENANT or ""))
+    # one profile per controller, next to its archive
+    SDWAN_PROFILE_JSON = SDWAN_CONFIG + ".profile.json" if settings["SDWAN_PROFILE_JSON"] else None
+
+    log_path = SDWAN_CONFIG + ".log"
+    result = "ok"
+    start = time.monotonic()
+    with open(log_path, "w") as log, redirect_stdout(log):
+        # no one to answer the confirmations of the clean actions
+        sys.stdin = open(os.devnull)
+        try:
+            sdwanp = rest_api_lib(SDWAN_IP, SDWAN_USERNAME, SDWAN_PASSWORD, SDWAN_POOL_SIZE, SDWAN_CA_BUNDLE, SDWAN_WORKERS, SDWAN_RATE,
+                                  SDWAN_TENANT, SDWAN_SESSION_CACHE, SDWAN_CACHE)
+            sdwanp_async = async_rest_api_lib(sdwanp, SDWAN_WORKERS)
+            with sdwanp.profile.stage(SDWAN_ACTION):
+                run_action(SDWAN_ACTION)
+            print_run_stats()
+        except (Exception, SystemExit) as e:
+            traceback.print_exc(file=log)
+            result = "failed: {}".format(e)
+
+    return OrderedDict([("host", SDWAN_IP), ("tenant", SDWAN_TENANT or ""), ("archive", controller["archive"]),
+                        ("result", result), ("seconds", time.monotonic() - start), ("log", log_path)])
+
+def run_inventory(inventory_path, parallel, settings):
+    """Run the action against every controller of the inventory
+
+        Controllers run in a pool of parallel processes, each with its own
+        -workers requests in flight. Prints a consolidated report and
+        returns the number of failed controllers.
+
+    """
+    controllers = load_inventory(inventory_path)
+    print("Running {} on {} controllers, {} at a time".format(settings["SDWAN_ACTION"], len(controllers), parallel))
+    print("")
+
+    start = time.monotonic()
+    results = []
+    with ProcessPoolExecutor(max_workers=parallel) as executor:
+        futures = {}
+        for controller in controllers:
+            if controller["error"]:
+                # not run, reported with the others
+                result = OrderedDict([("host", controller["host"]), ("tenant", controller["tenant"] or ""), ("archive", controller["archive"]),
+                                      ("result", "failed: " + controller["error"]), ("seconds", 0.0), ("log", None)])
+                print("{host} {tenant} - {result}".format(**result))
+                results.append(result)
+            else:
+                future = executor.submit(run_controller, controller, settings)
+                futures[future] = len(results)
+                results.append(None)
+        for future in as_completed(futures):
+            result = future.result()
+            print("{host} {tenant} - {result} ({seconds:.1f}s)".format(**result))
+            results[futures[future]] = result
+    elapsed = time.monotonic() - start
+
+    failed = [result for result in results if result["result"] != "ok"]
+    print("")
+    print("Report:")
+    print("{:<30} {:<16} {:>9}  {:<40} {}".format("host", "tenant", "seconds", "archive", "result"))
+    for result in results:
+        print("{host:<30} {tenant:<16} {seconds:>9.1f}  {archive:<40} {result}".format(**result))
+    print("")
+    print("{} controllers, {} ok, {} failed in {:.1f}s".format(len(results), len(results) - len(failed), len(failed), elapsed))
+    for result in failed:
+        if result["log"]:
+            print("See {} for {}".format(result["log"], result["host"]))
+    return len(failed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('vManage', nargs='?', help='vManage IP address or DNS name')
+    parser.add_argument('username', nargs='?', help='Username to login the vManage')
+    parser.add_argument('password', nargs='?', help='Password to login the vManage')
+    parser.add_argument('action', nargs='?', help='Action to execute on the vManage')
+    parser.add_argument('configfile', default=CONFIG_ARCH, nargs='?', help='Optional, specific export and import archive name')
+    parser.add_argument('-tenant', '--tenant', required=False, help='Specify tenant in multi-tenant setup')
+    parser.add_argument('-all-tenants', '--all-tenants', action='store_true', help='Export every tenant from the provider login, each to its own archive')
+    parser.add_argument('-since', '--since', required=False, help='Previous export archive, only objects changed since are fetched')
+    parser.add_argument('-bulk', '--bulk', action='store_true', help='Export straight from the listings that carry the full objects')
+    parser.add_argument('-workers', '--workers', type=int, default=1, help='Maximum number of requests in flight to the vManage (default: 1)')
+    parser.add_argument('-pool-size', '--pool-size', type=int, required=False, help='Maximum number of connections kept alive to the vManage (default: workers)')
+    parser.add_argument('-ca-bundle', '--ca-bundle', required=False, help='CA bundle to verify the vManage certificate, not verified without')
+    parser.add_argument('-rate', '--rate', type=float, required=False, help='Maximum number of requests per second to the vManage (default: unlimited)')
+    parser.add_argument('-journal', '--journal', required=False, help='Resume journal, objects an interrupted import created are not imported again')
+    parser.add_argument('-session-cache', '--session-cache', required=False, help='Session cache file, a valid cached session is reused instead of logging in')
+    parser.add_argument('-cache', '--cache', action='store_true', help='Cache the collections fetched for the run, writes to a collection drop its cache')
+    parser.add_argument('-chunk-size', '--chunk-size', type=int, default=100, help='Devices per certificate validity request (default: 100)')
+    parser.add_argument('-devices', '--devices', required=False, help='File of chassis or serial numbers, one per line, certificate, detach_devices and clean_devices actions only apply to them')
+    parser.add_argument('-profile', '--profile', action='store_true', help='Print the requests of each endpoint family and the wall time of each stage')
+    parser.add_argument('-profile-json', '--profile-json', required=False, help='Also write the profile as JSON to this file, next to each archive with -inventory')
+    parser.add_argument('-inventory', '--inventory', required=False, help='Inventory CSV of the vManages to run the action against, the action is then the only argument')
+    parser.add_argument('-parallel', '--parallel', type=int, default=4, help='Number of vManages of the inventory run at once (default: 4)')
+    args = parser.parse_args()
+
+    SDWAN_IP = args.vManage
+    SDWAN_USERNAME = args.username
+    SDWAN_PASSWORD = args.password
+    SDWAN_ACTION = args.action
+
+    SDWAN_FILE = args.configfile
+    SDWAN_TENANT = args.tenant
+    SDWAN_ALL_TENANTS = args.all_tenants
+    SDWAN_WORKERS = max(1, args.workers)
+    SDWAN_BULK = args.bulk
+    SDWAN_SINCE = os.path.join(DIR_PATH, args.since) if args.since else None
+    SDWAN_CHUNK_SIZE = max(1, args.chunk_size)
+    SDWAN_POOL_SIZE = max(1, args.pool_size or SDWAN_WORKERS)
+    SDWAN_CA_BUNDLE = args.ca_bundle
+    SDWAN_RATE = args.rate if args.rate and args.rate > 0 else None
+    SDWAN_CACHE = args.cache
+    SDWAN_PROFILE = args.profile
+    SDWAN_PROFILE_JSON = os.path.join(DIR_PATH, args.profile_json) if args.profile_json else None
+    SDWAN_SESSION_CACHE = session_cache(os.path.join(DIR_PATH, args.session_cache)) if args.session_cache else None
+    SDWAN_JOURNAL = import_journal(os.path.join(DIR_PATH, args.journal) if args.journal else None, "{}/{}".format(SDWAN_IP, SDWAN_TENANT or ""))
+    SDWAN_DEVICES = load_device_filter(os.path.join(DIR_PATH, args.devices)) if args.devices else None
+
+    if args.inventory:
+        # the action is the only positional argument
+        settings = {"SDWAN_ACTION": args.vManage,
+                    "SDWAN_WORKERS": SDWAN_WORKERS,
+                    "SDWAN_BULK": SDWAN_BULK,
+                    "SDWAN_ALL_TENANTS": SDWAN_ALL_TENANTS,
+                    "SDWAN_CHUNK_SIZE": SDWAN_CHUNK_SIZE,
+                    "SDWAN_POOL_SIZE": SDWAN_POOL_SIZE,
+                    "SDWAN_CA_BUNDLE": SDWAN_CA_BUNDLE,
+                    "SDWAN_RATE": SDWAN_RATE,
+                    "SDWAN_SESSION_CACHE": SDWAN_SESSION_CACHE,
+                    "SDWAN_CACHE": SDWAN_CACHE,
+                    "SDWAN_PROFILE": SDWAN_PROFILE,
+                    "SDWAN_PROFILE_JSON": SDWAN_PROFILE_JSON,
+                    "SDWAN_JOURNAL_PATH": SDWAN_JOURNAL.path,
+                    "SDWAN_DEVICES": SDWAN_DEVICES}
+        if args.vManage is None:
+            print("The action must be provided before running.")
+            print(__doc__)
+            print("")
+            exit("1")
+        if run_inventory(os.path.join(DIR_PATH, args.inventory), max(1, args.parallel), settings):
+            exit("1")
+        exit()
+
+    if SDWAN_IP is None or SDWAN_USERNAME is None or SDWAN_PASSWORD is None or SDWAN_ACTION is None:
+        print("CISCO SDWAN details must be provided before running.")
+        print(__doc__)
+        print("")
+        exit("1")
+
+    if SDWAN_ALL_TENANTS and (SDWAN_TENANT or SDWAN_ACTION != "export"):
+        print("-all-tenants only applies to export, as provider without -tenant.")
+        exit("1")
+
+    SDWAN_CONFIG = os.path.join(DIR_PATH, SDWAN_FILE)
+
+    sdwanp = rest_api_lib(SDWAN_IP, SDWAN_USERNAME, SDWAN_PASSWORD, SDWAN_POOL_SIZE, SDWAN_CA_BUNDLE, SDWAN_WORKERS, SDWAN_RATE,
+                          SDWAN_TENANT, SDWAN_SESSION_CACHE, SDWAN_CACHE)
+
+    sdwanp_async = async_rest_api_lib(sdwanp, SDWAN_WORKERS)
+
+    with sdwanp.profile.stage(SDWAN_ACTION):
+        run_action(SDWAN_ACTION)
+
+    print_run_stats()